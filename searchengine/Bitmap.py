@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import numpy
+
+# compressed bitmap of doc ids like Roaring bitmaps: doc ids are split into
+# chunks of 2**16 by their high bits, each chunk is stored in the smallest of
+# three containers of its low bits:
+# array: sorted uint16 array, for up to max_array_size doc ids
+# bitmap: 2**16 bits as uint8 array of chunk_size / 8 bytes, for dense chunks
+# run: sorted uint16 arrays of run starts and lengths - 1, for consecutive
+#      doc ids, only created by Bitmap.optimize
+# operations convert run containers to one of the others first
+chunk_bits = 16
+chunk_size = 1 << chunk_bits
+max_array_size = 4096
+bitmap_bytes = chunk_size // 8
+
+
+class ArrayContainer():
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def to_array(self):
+        return self.values
+
+    def contains(self, values):
+        return numpy.isin(values, self.values, assume_unique=True)
+
+
+class BitmapContainer():
+    def __init__(self, bits):
+        self.bits = bits
+        self.cardinality = int(bit_counts[bits].sum())
+
+    def __len__(self):
+        return self.cardinality
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_array(self):
+        return numpy.flatnonzero(numpy.unpackbits(
+            self.bits, bitorder='little')).astype(numpy.uint16)
+
+    def contains(self, values):
+        return (self.bits[values >> 3] >> (values & 7).astype(numpy.uint8)
+                & 1).astype(bool)
+
+
+class RunContainer():
+    def __init__(self, starts, lengths):
+        self.starts = starts
+        self.lengths = lengths  # run lengths - 1, so they fit into uint16
+
+    def __len__(self):
+        return int(self.lengths.sum()) + len(self.lengths)
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.lengths.nbytes
+
+    def to_array(self):
+        lengths = self.lengths.astype(numpy.int64) + 1
+        return (numpy.arange(lengths.sum()) + numpy.repeat(
+            self.starts - (numpy.cumsum(lengths) - lengths),
+            lengths)).astype(numpy.uint16)
+
+
+bit_counts = numpy.array([bin(i).count('1') for i in range(256)],
+                         dtype=numpy.int64)
+
+
+def to_bits(values):
+    is_set = numpy.zeros(chunk_size, dtype=bool)
+    is_set[values] = True
+    return numpy.packbits(is_set, bitorder='little')
+
+
+# returns the smallest array or bitmap container of the sorted uint16 values
+def container_of_array(values):
+    if len(values) <= max_array_size:
+        return ArrayContainer(values)
+    return BitmapContainer(to_bits(values))
+
+
+def container_of_bits(bits):
+    container = BitmapContainer(bits)
+    if len(container) <= max_array_size:
+        return ArrayContainer(container.to_array())
+    return container
+
+
+def without_runs(container):
+    if isinstance(container, RunContainer):
+        return container_of_array(container.to_array())
+    return container
+
+
+def and_containers(container, other):
+    container, other = without_runs(container), without_runs(other)
+    if isinstance(container, ArrayContainer):
+        return ArrayContainer(container.values[other.contains(
+            container.values)])
+    if isinstance(other, ArrayContainer):
+        return ArrayContainer(other.values[container.contains(other.values)])
+    return container_of_bits(container.bits & other.bits)
+
+
+def or_containers(container, other):
+    container, other = without_runs(container), without_runs(other)
+    if isinstance(container, ArrayContainer) and \
+            isinstance(other, ArrayContainer):
+        return container_of_array(numpy.union1d(
+            container.values, other.values))
+    bits = [to_bits(part.values) if isinstance(part, ArrayContainer)
+            else part.bits for part in (container, other)]
+    return BitmapContainer(bits[0] | bits[1])
+
+
+def and_not_containers(container, other):
+    container, other = without_runs(container), without_runs(other)
+    if isinstance(container, ArrayContainer):
+        return ArrayContainer(container.values[~other.contains(
+            container.values)])
+    other_bits = to_bits(other.values) \
+        if isinstance(other, ArrayContainer) else other.bits
+    return container_of_bits(container.bits & ~other_bits)
+
+
+class Bitmap():
+    # keys: sorted list of the high bits of the chunks, containers: their
+    # non empty containers
+    def __init__(self, keys=(), containers=()):
+        self.keys = list(keys)
+        self.containers = list(containers)
+
+    # doc_ids: sorted array of unique non negative doc ids
+    @staticmethod
+    def from_sorted(doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        high_bits = doc_ids >> chunk_bits
+        chunk_starts = numpy.flatnonzero(numpy.diff(high_bits, prepend=-1))
+        chunk_ends = numpy.append(chunk_starts[1:], len(doc_ids))
+        return Bitmap(high_bits[chunk_starts].tolist(), [
+            container_of_array(
+                (doc_ids[start:end] & (chunk_size - 1)).astype(numpy.uint16))
+            for start, end in zip(chunk_starts.tolist(), chunk_ends.tolist())])
+
+    def __len__(self):
+        return sum(len(container) for container in self.containers)
+
+    @property
+    def nbytes(self):
+        return sum(container.nbytes for container in self.containers)
+
+    # returns the sorted array of all doc ids
+    def to_array(self):
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [
+            (key << chunk_bits) + container.to_array().astype(numpy.int64)
+            for key, container in zip(self.keys, self.containers)])
+
+    def __and__(self, other):
+        other_containers = dict(zip(other.keys, other.containers))
+        keys, containers = [], []
+        for key, container in zip(self.keys, self.containers):
+            if key in other_containers:
+                result = and_containers(container, other_containers[key])
+                if len(result) > 0:
+                    keys.append(key)
+                    containers.append(result)
+        return Bitmap(keys, containers)
+
+    def __or__(self, other):
+        containers = dict(zip(self.keys, self.containers))
+        for key, container in zip(other.keys, other.containers):
+            containers[key] = or_containers(containers[key], container) \
+                if key in containers else container
+        keys = sorted(containers.keys())
+        return Bitmap(keys, [containers[key] for key in keys])
+
+    # and not
+    def __sub__(self, other):
+        other_containers = dict(zip(other.keys, other.containers))
+        keys, containers = [], []
+        for key, container in zip(self.keys, self.containers):
+            if key in other_containers:
+                container = and_not_containers(
+                    container, other_containers[key])
+            if len(container) > 0:
+                keys.append(key)
+                containers.append(container)
+        return Bitmap(keys, containers)
+
+    # replaces containers by run containers where these are smaller
+    def optimize(self):
+        for i, container in enumerate(self.containers):
+            values = container.to_array().astype(numpy.int64)
+            run_starts = numpy.flatnonzero(numpy.diff(values, prepend=-2) != 1)
+            if 4 * len(run_starts) < container.nbytes:
+                run_ends = numpy.append(run_starts[1:], len(values)) - 1
+                self.containers[i] = RunContainer(
+                    values[run_starts].astype(numpy.uint16),
+                    (values[run_ends] - values[run_starts]).astype(
+                        numpy.uint16))
+        return self
+
+
+if __name__ == '__main__':
+    random = numpy.random.RandomState(0)
+    sets = [numpy.unique(random.randint(0, 300000, size)) for size in
+            (100, 20000, 150000)]
+    sets.append(numpy.arange(70000, 200000))
+    bitmaps = [Bitmap.from_sorted(doc_ids) for doc_ids in sets]
+    bitmaps[3].optimize()
+    assert(isinstance(bitmaps[3].containers[1], RunContainer))
+    for doc_ids, bitmap in zip(sets, bitmaps):
+        assert(numpy.array_equal(bitmap.to_array(), doc_ids))
+        assert(len(bitmap) == len(doc_ids))
+        for other_doc_ids, other in zip(sets, bitmaps):
+            assert(numpy.array_equal(
+                (bitmap & other).to_array(),
+                numpy.intersect1d(doc_ids, other_doc_ids)))
+            assert(numpy.array_equal((bitmap | other).to_array(),
+                                     numpy.union1d(doc_ids, other_doc_ids)))
+            assert(numpy.array_equal((bitmap - other).to_array(),
+                                     numpy.setdiff1d(doc_ids, other_doc_ids)))
+    print(f'{len(sets[2])} doc ids in {bitmaps[2].nbytes} bytes')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+
+
+# least recently used cache bounded by the total size of its values in bytes
+# instead of the number of entries, so a few huge posting lists cannot push
+# the memory usage beyond max_size
+class LRUCache():
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (value, size), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    # returns None for keys which are not cached
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    # values larger than max_size are not cached at all
+    def put(self, key, value, size):
+        self.discard(key)
+        if size > self.max_size:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def discard(self, key):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+    # removes all entries whose key satisfies predicate
+    def discard_if(self, predicate):
+        for key in [key for key in self.entries.keys() if predicate(key)]:
+            self.discard(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def statistics(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.0,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'size': self.size, 'max_size': self.max_size}
+
+
+if __name__ == '__main__':
+    cache = LRUCache(10)
+    cache.put('a', 'a', 4)
+    cache.put('b', 'b', 4)
+    assert(cache.get('a') == 'a')
+    cache.put('c', 'c', 4)  # evicts b, the least recently used entry
+    assert(cache.get('b') is None and cache.get('c') == 'c')
+    cache.put('d', 'd', 11)  # too large
+    assert('d' not in cache and cache.size == 8)
+    print(cache.statistics())
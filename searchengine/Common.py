@@ -1,4 +1,8 @@
 import csv
+import mmap
+import os
+
+import numpy
 
 posting_list_separator = '\a'  # 
 
@@ -77,3 +81,77 @@ def first_n(iterable, n):
         if i == n:
             break
         yield element
+
+
+# returns the indices into sorted_array of all values contained in it and a
+# boolean mask of the contained values
+def find_sorted(sorted_array, values):
+    indices = numpy.searchsorted(sorted_array, values)
+    is_contained = indices < len(sorted_array)
+    is_contained[is_contained] = \
+        sorted_array[indices[is_contained]] == values[is_contained]
+    return indices[is_contained], is_contained
+
+
+# returns the intersection of two sorted arrays of unique values, the values
+# of a much smaller array are looked up by binary search in the larger one
+# (galloping) instead of merging both
+def intersect_sorted(values, other_values, galloping_ratio=16):
+    if len(values) > len(other_values):
+        values, other_values = other_values, values
+    if len(values) * galloping_ratio < len(other_values):
+        return values[find_sorted(other_values, values)[1]]
+    return numpy.intersect1d(values, other_values, assume_unique=True)
+
+
+# returns the concatenation of the ranges [start, start + count)
+def concatenate_ranges(starts, counts):
+    return numpy.arange(counts.sum()) + numpy.repeat(
+        starts - (numpy.cumsum(counts) - counts), counts)
+
+
+# returns the indices into sorted_array of all elements equal to any of values
+def find_sorted_all(sorted_array, values):
+    starts = numpy.searchsorted(sorted_array, values, side='left')
+    ends = numpy.searchsorted(sorted_array, values, side='right')
+    return concatenate_ranges(starts, ends - starts)
+
+
+# read only memory map of a whole file, can be shared between processes
+def memory_map(file_path):
+    if os.stat(file_path).st_size == 0:
+        return b''
+    with open(file_path, mode='rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# strings are stored as one UTF-8 encoded file and an array of start offsets,
+# so they can be memory mapped instead of being unpickled
+# existing files are replaced instead of overwritten, memory maps of running
+# search engines keep the old files
+def save_string_table(path_prefix, strings):
+    encoded_strings = [string.encode() for string in strings]
+    offsets = numpy.zeros(len(encoded_strings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(encoded) for encoded in encoded_strings],
+                 out=offsets[1:])
+    with open(f'{path_prefix}_strings.tmp', mode='wb') as f:
+        f.write(b''.join(encoded_strings))
+    with open(f'{path_prefix}_string_offsets.npy.tmp', mode='wb') as f:
+        numpy.save(f, offsets)
+    os.replace(f'{path_prefix}_strings.tmp', f'{path_prefix}_strings')
+    os.replace(f'{path_prefix}_string_offsets.npy.tmp',
+               f'{path_prefix}_string_offsets.npy')
+
+
+class StringTable():
+    def __init__(self, path_prefix):
+        self.data = memory_map(f'{path_prefix}_strings')
+        self.offsets = numpy.load(
+            f'{path_prefix}_string_offsets.npy', mmap_mode='r')
+
+    def __getitem__(self, index):
+        return self.data[
+            self.offsets[index]:self.offsets[index + 1]].decode()
+
+    def __len__(self):
+        return len(self.offsets) - 1
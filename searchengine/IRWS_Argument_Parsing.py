@@ -5,11 +5,14 @@ import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument("query", help="a txt file with one boolean, keyword,"
-                    "phrase, ReplyTo, or Index query per line")
+                    "phrase, wildcard, ReplyTo, ThreadOf, DescendantsOf, or "
+                    "Index query per line")
 parser.add_argument("--topN", help="the maximum number of search hits to be"
                     " printed", type=int)
 parser.add_argument("--printIdsOnly", help="print only commentIds and not ids"
                     " and their corresponding comments", action="store_true")
+parser.add_argument("--proximityBoost", help="rank comments containing query"
+                    " terms close to each other higher", action="store_true")
 
 args = parser.parse_args()
 if args.printIdsOnly:
@@ -1,33 +1,45 @@
 #!/usr/bin/env python3
 
-import pickle
-import io
 import os
-import functools
 import sys
 import multiprocessing
 import csv
-from collections import Counter
+import struct
+import heapq
+import itertools
+import operator
+import shutil
+import threading
 
 import numpy
 import Stemmer
 import nltk.tokenize
 from dawg import RecordDAWG
-from bitarray import bitarray as BitArray
 
-import Huffman
+import Postings
+import KGramIndex
+import StoredFields
 from Report import Report
 from Common import *
+from Segment import *
 
 
-def process_comments_file(directory, start_offset, end_offset,
-                          comments_per_output_file=200000):
+# process data between the given offsets, partial indices are written to
+# output_directory, returns start_offset, the names of the written partial
+# indices, the comment_infos (arrays of the cids, offsets and parent cids
+# of the comments in order of the comments, -1 for no parent), the file
+# path, block record counts and block sizes of the written stored fields and
+# a dict of all words of the comments to their stems
+def process_comments_file(directory, output_directory, start_offset,
+                          end_offset, comments_per_output_file=200000):
     assert(start_offset < end_offset)
-    # process data between the given offsets
     comment_list = []
     file_number = 0
-    reply_to_index = {}
-    cid_to_offset = {}
+    partial_index_names = []
+    cids = []
+    cid_offsets = []
+    parent_cids = []
+    words = {}
     with open(f'{directory}/comments.csv', mode='rb') as f:
         f.seek(start_offset)
         previous_offset = start_offset
@@ -35,36 +47,40 @@ def process_comments_file(directory, start_offset, end_offset,
 
         tokenizer = nltk.tokenize.ToktokTokenizer()
         stemmer = Stemmer.Stemmer('english')
-        stem = functools.lru_cache(100)(stemmer.stemWord)
+        stored_fields_path = f'{output_directory}/{end_offset}_stored_fields'
+        stored_fields_writer = StoredFields.StoredFieldsWriter(
+            stored_fields_path)
 
         for csv_line in csv_reader:
             if(not 6 <= len(csv_line) <= 8):
                 print(f'WARNING: len(csv_line) == {len(csv_line)}',
                       'which is not between 6 and 8')
-            cid = int(csv_line[0])
+            record = StoredFields.parse_record(csv_line)
+            stored_fields_writer.add(record)
+            cid = record[0]
 
-            cid_to_offset[cid] = previous_offset
+            cids.append(cid)
+            cid_offsets.append(previous_offset)
 
             comment = (previous_offset, [])
             comment_text_lower = csv_line[3].lower()
             for sentence in nltk.tokenize.sent_tokenize(comment_text_lower):
-                for token in tokenizer.tokenize(sentence):
-                    comment[1].append(stemmer.stemWord(token))
+                tokens = tokenizer.tokenize(sentence)
+                stems = stemmer.stemWords(tokens)
+                comment[1].extend(stems)
+                words.update(zip(tokens, stems))
             comment_list.append(comment)
 
-            parent_cid = int(csv_line[5]) if csv_line[5] != '' else -1
-            if parent_cid != -1:
-                if parent_cid not in reply_to_index.keys():
-                    reply_to_index[parent_cid] = [cid]
-                else:
-                    reply_to_index[parent_cid].append(cid)
+            parent_cids.append(record[5])
 
             previous_offset = f.tell()
 
             if len(comment_list) == comments_per_output_file \
                     or previous_offset == end_offset:
-                write_comments_to_temp_file(
-                    comment_list, f'{directory}/{end_offset}_{file_number}')
+                partial_index_name = \
+                    f'{output_directory}/{end_offset}_{file_number}'
+                write_comments_to_temp_file(comment_list, partial_index_name)
+                partial_index_names.append(partial_index_name)
                 file_number += 1
                 comment_list = []
                 if previous_offset == end_offset:
@@ -72,16 +88,13 @@ def process_comments_file(directory, start_offset, end_offset,
 
             assert(previous_offset < end_offset)
 
-    with open(f'{directory}/{end_offset}_file_number.pickle', mode='wb') as f:
-        pickle.dump(file_number, f, pickle.HIGHEST_PROTOCOL)
+    return (start_offset, partial_index_names,
+            numpy.array([cids, cid_offsets, parent_cids], dtype=numpy.int64),
+            (stored_fields_path,) + stored_fields_writer.close(), words)
 
-    with open(f'{directory}/{end_offset}_reply_to_index.pickle',
-              mode='wb') as f:
-        pickle.dump(reply_to_index, f, pickle.HIGHEST_PROTOCOL)
 
-    with open(f'{directory}/{end_offset}_cid_to_offset.pickle',
-              mode='wb') as f:
-        pickle.dump(cid_to_offset, f, pickle.HIGHEST_PROTOCOL)
+def process_comments_chunk(arguments):
+    return process_comments_file(*arguments)
 
 
 def write_comments_to_temp_file(comment_list, file_name_prefix):
@@ -105,32 +118,124 @@ def write_comments_to_temp_file(comment_list, file_name_prefix):
             else:
                 all_comment_dict[stem].append((comment[0], positions))
                 term_count_dict[stem] += len(positions)
-    collection_term_count = sum(comment_term_count_dict.values())
 
-    with open(f'{file_name_prefix}_index.csv', mode='wb') as f:
+    with open(f'{file_name_prefix}_index.run', mode='wb',
+              buffering=write_buffer_size) as f:
         for stem in sorted(all_comment_dict.keys()):
             if len(stem) > 1 and len(stem) <= 128:
                 posting_list = all_comment_dict[stem]
-                escaped_stem = stem.replace('"', '""')
-                line_string = f'"{escaped_stem}"' \
-                    f'{posting_list_separator}{term_count_dict[stem]}'
-                for posting_list_parts in posting_list:
-                    line_string += \
-                        f'{posting_list_separator}{posting_list_parts[0]},'
-                    # list of token positions in comment
-                    line_string += ','.join(
-                        (str(i) for i in posting_list_parts[1]))
-                line_string += '\n'
-                line_raw = line_string.encode()
-                f.write(line_raw)
-
-    with open(f'{file_name_prefix}_comment_term_count_dict.pickle',
-              mode='wb') as f:
-        pickle.dump(comment_term_count_dict, f, pickle.HIGHEST_PROTOCOL)
-
-    with open(f'{file_name_prefix}_collection_term_count.pickle',
-              mode='wb') as f:
-        pickle.dump(collection_term_count, f, pickle.HIGHEST_PROTOCOL)
+                term_frequencies = [len(positions)
+                                    for offset, positions in posting_list]
+                write_run_record(
+                    f, stem, term_count_dict[stem], len(posting_list),
+                    Postings.encode_postings(
+                        [offset for offset, positions in posting_list],
+                        term_frequencies,
+                        [position for offset, positions in posting_list
+                         for position in positions]))
+
+    numpy.save(f'{file_name_prefix}_comment_term_counts.npy', numpy.array(
+        [list(comment_term_count_dict.keys()),
+         list(comment_term_count_dict.values())], dtype=numpy.int64))
+
+
+# partial indices are written as runs of records sorted by stem:
+# header (stem size, term count, document count, postings size) | stem |
+# postings in the format of Postings.encode_postings, but with comment offsets
+# instead of doc ids
+run_record_header = struct.Struct('<HQQQ')
+write_buffer_size = 2**22
+
+
+def write_run_record(run_file, stem, term_count, document_count, postings):
+    encoded_stem = stem.encode()
+    run_file.write(run_record_header.pack(
+        len(encoded_stem), term_count, document_count, len(postings)))
+    run_file.write(encoded_stem)
+    run_file.write(postings)
+
+
+def read_run_file(run_file_path):
+    with open(run_file_path, mode='rb', buffering=write_buffer_size) \
+            as run_file:
+        header = run_file.read(run_record_header.size)
+        while header:
+            stem_size, term_count, document_count, postings_size = \
+                run_record_header.unpack(header)
+            stem = run_file.read(stem_size).decode()
+            yield (stem, term_count, document_count,
+                   run_file.read(postings_size))
+            header = run_file.read(run_record_header.size)
+
+
+# k-way merge of runs, yields stem, term_count, document_count and a list of
+# (postings, document_count, term_count) of all runs containing the stem in
+# order of run_file_paths
+def merge_run_files(run_file_paths):
+    records = heapq.merge(*(read_run_file(run_file_path)
+                            for run_file_path in run_file_paths),
+                          key=operator.itemgetter(0))
+    for stem, stem_records in itertools.groupby(
+            records, key=operator.itemgetter(0)):
+        run_postings = [(postings, document_count, term_count)
+                        for _, term_count, document_count, postings
+                        in stem_records]
+        yield (stem, sum(term_count for _, _, term_count in run_postings),
+               sum(document_count for _, document_count, _ in run_postings),
+               run_postings)
+
+
+def concatenate_run_postings(run_postings):
+    decoded_run_postings = [
+        Postings.decode_postings(postings, document_count, term_count)
+        for postings, document_count, term_count in run_postings]
+    return tuple(numpy.concatenate(arrays)
+                 for arrays in zip(*decoded_run_postings))
+
+
+# yields stem, doc ids, term frequencies and positions of the merged runs,
+# comment_offsets maps the doc ids to the comment offsets used in the runs
+def run_posting_lists(run_file_paths, comment_offsets):
+    for stem, _, _, run_postings in merge_run_files(run_file_paths):
+        offsets, term_frequencies, positions = \
+            concatenate_run_postings(run_postings)
+        yield (stem, numpy.searchsorted(comment_offsets, offsets),
+               term_frequencies, positions)
+
+
+def segment_stems(segment_index, segment):
+    for stem in sorted(segment.seek_list.keys()):
+        yield stem, segment_index
+
+
+# yields stem, doc ids, term frequencies and positions of the posting lists
+# of all segments without deleted docs, doc ids of segments[i] are mapped by
+# live_doc_id_maps[i] and shifted by doc_id_bases[i]
+def segment_posting_lists(segments, doc_id_bases, live_doc_id_maps):
+    stems = heapq.merge(*(segment_stems(segment_index, segment)
+                          for segment_index, segment in enumerate(segments)))
+    for stem, stem_segments in itertools.groupby(
+            stems, key=operator.itemgetter(0)):
+        posting_lists = []
+        for _, segment_index in stem_segments:
+            segment = segments[segment_index]
+            posting_list = segment.open_posting_list(stem).decode()
+            if segment.is_deleted is not None:
+                posting_list = posting_list.select(
+                    ~segment.is_deleted[posting_list.doc_ids])
+            posting_list.doc_ids = doc_id_bases[segment_index] + \
+                live_doc_id_maps[segment_index][posting_list.doc_ids]
+            if len(posting_list) > 0:
+                posting_lists.append(posting_list)
+        if len(posting_lists) == 0:
+            continue
+        yield (stem,
+               numpy.concatenate([posting_list.doc_ids
+                                  for posting_list in posting_lists]),
+               numpy.concatenate([posting_list.term_frequencies
+                                  for posting_list in posting_lists]),
+               numpy.concatenate([posting_list.positions
+                                  for posting_list in posting_lists]))
 
 
 def create_list_from_csv(csv_file_path):
@@ -143,305 +248,536 @@ def create_list_from_csv(csv_file_path):
     return result_list
 
 
+# returns the largest level such that document_count is at least
+# min_segment_size * merge_factor**level, 0 for smaller segments, in integer
+# arithmetic since float logarithms are off at exact powers
+def get_merge_level(document_count, merge_factor, min_segment_size):
+    level = 0
+    while document_count >= min_segment_size * merge_factor**(level + 1):
+        level += 1
+    return level
+
+
 class IndexCreator():
     def __init__(self, directory):
         self.directory = directory
         assert(os.path.isfile(f'{self.directory}/comments.csv'))
         sys.setrecursionlimit(10000)
         self.report = Report(quiet_mode=False)
-
-    def create_index(self):
-        # read csv to create comment_list
+        # changes of segments.json by updates, deletions and background
+        # merges of this index creator are serialized, only one index creator
+        # may write to a directory at a time
+        self.segment_infos_lock = threading.RLock()
+        # only one thread merges segments at a time
+        self.merge_lock = threading.Lock()
+
+    # returns the end of the last complete line of comments.csv, the crawler
+    # may be appending to it while it is indexed
+    def get_comments_file_end(self):
+        with open(f'{self.directory}/comments.csv', mode='rb') as f:
+            end_offset = f.seek(0, os.SEEK_END)
+            while end_offset > 0:
+                f.seek(max(end_offset - 4096, 0))
+                data = f.read(end_offset - max(end_offset - 4096, 0))
+                newline_position = data.rfind(b'\n')
+                if newline_position != -1:
+                    return end_offset - len(data) + newline_position + 1
+                end_offset -= len(data)
+        return 0
+
+    # returns offsets of line starts splitting comments.csv between the given
+    # offsets into number_of_chunks chunks of roughly equal size
+    def split_comments_file(self, start_offset, end_offset, number_of_chunks):
+        offsets = [start_offset]
+        with open(f'{self.directory}/comments.csv', mode='rb') as f:
+            for i in range(1, number_of_chunks):
+                f.seek(start_offset + int(
+                    i * (end_offset - start_offset) / number_of_chunks))
+                f.readline()
+                next_offset = min(f.tell(), end_offset)
+                if next_offset != offsets[-1]:
+                    offsets.append(next_offset)
+        if offsets[-1] != end_offset:
+            offsets.append(end_offset)
+        return offsets
+
+    # returns the name of a new segment directory
+    def create_segment_directory(self):
+        with self.segment_infos_lock:
+            segment_infos = load_segment_infos(self.directory)
+            segment_name = f'segment_{segment_infos["next_segment_number"]}'
+            segment_infos['next_segment_number'] += 1
+            save_segment_infos(self.directory, segment_infos)
+        os.makedirs(f'{self.directory}/{segment_name}')
+        return segment_name
+
+    # replaces the segments with the names old_segment_names by new_segments
+    # at the position of the first old segment (or at the end) and marks the
+    # comments with deleted_cids as deleted in the other segments, search
+    # engines switch to the new generation of segments with their next query
+    # returns False if the old segments are not live anymore
+    def replace_segments(self, old_segment_names, new_segments,
+                         deleted_cids=()):
+        with self.segment_infos_lock:
+            segment_infos = load_segment_infos(self.directory)
+            segment_names = [segment_info['name']
+                             for segment_info in segment_infos['segments']]
+            if not all(segment_name in segment_names
+                       for segment_name in old_segment_names):
+                return False
+            position = segment_names.index(old_segment_names[0]) \
+                if len(old_segment_names) > 0 else len(segment_names)
+            segment_infos['segments'] = [
+                segment_info for segment_info in segment_infos['segments']
+                if segment_info['name'] not in old_segment_names]
+            segment_infos['generation'] += 1
+            replaced_file_paths = self.mark_deleted(
+                segment_infos['segments'], deleted_cids,
+                segment_infos['generation'])
+            segment_infos['segments'][position:position] = new_segments
+            save_segment_infos(self.directory, segment_infos)
+        # search engines still using the old files keep their memory maps
+        for segment_name in old_segment_names:
+            shutil.rmtree(f'{self.directory}/{segment_name}')
+        for file_path in replaced_file_paths:
+            os.remove(file_path)
+        return True
+
+    # marks the comments with the given cids as deleted in the segments,
+    # the deleted docs files of changed segments are written for generation,
+    # returns the paths of the replaced deleted docs files
+    def mark_deleted(self, segment_infos, cids, generation):
+        cids = numpy.asarray(cids, dtype=numpy.int64)
+        replaced_file_paths = []
+        if len(cids) == 0:
+            return replaced_file_paths
+        for segment_info in segment_infos:
+            segment_directory = f'{self.directory}/{segment_info["name"]}'
+            indices = find_sorted_all(numpy.load(
+                f'{segment_directory}/cids.npy', mmap_mode='r'), cids)
+            doc_ids = numpy.load(f'{segment_directory}/cid_doc_ids.npy',
+                                 mmap_mode='r')[indices]
+            is_deleted = load_deleted_docs(segment_directory, segment_info)
+            if is_deleted[doc_ids].all():
+                continue
+            if segment_info.get('deleted_docs') is not None:
+                replaced_file_paths.append(
+                    f'{segment_directory}/{segment_info["deleted_docs"]}')
+            is_deleted[doc_ids] = True
+            self.set_deleted_docs(segment_info, is_deleted, generation)
+        return replaced_file_paths
+
+    def set_deleted_docs(self, segment_info, is_deleted, generation):
+        segment_info['deleted_docs'] = f'deleted_docs_{generation}.npy'
+        segment_info['deleted_count'] = int(is_deleted.sum())
+        save_deleted_docs(f'{self.directory}/{segment_info["name"]}/'
+                          f'{segment_info["deleted_docs"]}', is_deleted)
+
+    # returns the sorted cids of all deleted comments and the end of
+    # comments.csv at the time of their last deletion
+    def load_deleted_comments(self):
+        try:
+            return numpy.load(
+                f'{self.directory}/{deleted_comments_file_name}')
+        except FileNotFoundError:
+            return numpy.zeros((2, 0), dtype=numpy.int64)
+
+    # deletes all lines of the comments with the given cids in comments.csv
+    # from the index, also the ones which are not indexed yet
+    def delete_comments(self, cids):
+        cids = numpy.asarray(cids, dtype=numpy.int64)
+        with self.segment_infos_lock:
+            deleted_comments = numpy.concatenate((
+                self.load_deleted_comments(),
+                [cids, numpy.full(len(cids), self.get_comments_file_end())]),
+                axis=1)
+            # only the last deletion of every cid is kept
+            order = numpy.lexsort(deleted_comments[::-1])
+            deleted_comments = deleted_comments[:, order]
+            is_last = numpy.append(
+                deleted_comments[0][:-1] != deleted_comments[0][1:], True)
+            temp_file_path = \
+                f'{self.directory}/{deleted_comments_file_name}.tmp'
+            with open(temp_file_path, mode='wb') as f:
+                numpy.save(f, deleted_comments[:, is_last])
+            os.replace(temp_file_path,
+                       f'{self.directory}/{deleted_comments_file_name}')
+            self.replace_segments([], [], cids)
+
+    # returns a boolean array marking the comments of a new segment which are
+    # replaced by a later line with the same cid or were deleted
+    def find_deleted_docs(self, comment_offsets, comment_cids):
+        is_deleted = numpy.zeros(len(comment_offsets), dtype=bool)
+        order = numpy.argsort(comment_cids, kind='stable')
+        is_deleted[order[:-1][comment_cids[order[:-1]]
+                              == comment_cids[order[1:]]]] = True
+        deleted_cids, deletion_offsets = self.load_deleted_comments()
+        indices, is_contained = find_sorted(deleted_cids, comment_cids)
+        is_deleted[is_contained] |= \
+            comment_offsets[is_contained] < deletion_offsets[indices]
+        return is_deleted
+
+    # indexes all of comments.csv into a single segment replacing all
+    # existing segments
+    # number_of_processes: defaults to the number of cores
+    # chunks_per_process: comments.csv is split into more chunks than
+    # processes, idle processes take the next unprocessed chunk, so slow
+    # chunks do not leave other cores waiting
+    def create_index(self, number_of_processes=None, chunks_per_process=8):
+        old_segment_names = [
+            segment_info['name'] for segment_info
+            in load_segment_infos(self.directory)['segments']]
+        end_offset = self.get_comments_file_end()
+        new_segments = [] if end_offset == 0 else [self.create_segment(
+            0, end_offset, number_of_processes, chunks_per_process)]
+        self.replace_segments(old_segment_names, new_segments)
+        self.save_string_tables()
+
+    # indexes the comments appended to comments.csv since the last update
+    # into a new segment, afterwards segments are merged according to the
+    # merge policy, with merge_in_background the merges run in a thread
+    # which is returned
+    # comments edited on Disqus are appended to comments.csv again, their
+    # older lines are deleted when the new ones are indexed
+    def update_index(self, number_of_processes=None, chunks_per_process=8,
+                     merge_in_background=False):
+        segments = load_segment_infos(self.directory)['segments']
+        start_offset = segments[-1]['end_offset'] if len(segments) > 0 else 0
+        end_offset = self.get_comments_file_end()
+        if start_offset < end_offset:
+            segment = self.create_segment(
+                start_offset, end_offset, number_of_processes,
+                chunks_per_process)
+            self.replace_segments([], [segment], numpy.load(
+                f'{self.directory}/{segment["name"]}/cids.npy'))
+            self.save_string_tables()
+
+        if merge_in_background:
+            merge_thread = threading.Thread(target=self.merge_segments)
+            merge_thread.start()
+            return merge_thread
+        self.merge_segments()
+
+    # indexes the comments between the given offsets into a new segment and
+    # returns its segment info
+    def create_segment(self, start_offset, end_offset,
+                       number_of_processes=None, chunks_per_process=8):
+        segment_name = self.create_segment_directory()
+        segment_directory = f'{self.directory}/{segment_name}'
 
         with self.report.measure('processing comments.csv'):
-            number_of_processes = min(os.cpu_count(), 2)
-            print(f'starting {number_of_processes} processes')
-            csv_size = os.stat(f'{self.directory}/comments.csv').st_size
+            if number_of_processes is None:
+                number_of_processes = os.cpu_count()
+            offsets = self.split_comments_file(
+                start_offset, end_offset,
+                number_of_processes * chunks_per_process)
+            print(f'starting {number_of_processes} processes for',
+                  f'{len(offsets) - 1} chunks')
+
+            partial_results = []
             with multiprocessing.Pool(processes=number_of_processes) as pool:
-                offsets = [0]
-                with open(f'{self.directory}/comments.csv', mode='rb') as f:
-                    for i in range(1, number_of_processes + 1):
-                        f.seek(int(i * csv_size / number_of_processes))
-                        f.readline()
-                        next_offset = f.tell()
-                        if next_offset != offsets[-1]:
-                            offsets.append(next_offset)
-
-                def on_error(exception):
-                    raise exception
-                for start_offset, end_offset in zip(offsets, offsets[1:]):
-                    pool.apply_async(
-                        process_comments_file,
-                        args=(self.directory, start_offset, end_offset),
-                        error_callback=on_error)
-                pool.close()
-                pool.join()
-
-            self.partial_index_names = []
-            reply_to_index = {}
-            cid_to_offset = {}
-            for end_offset in offsets[1:]:
-                file_number_path = \
-                    f'{self.directory}/{end_offset}_file_number.pickle'
-                with open(file_number_path, mode='rb') as f:
-                    file_number = pickle.load(f)
-                    for i in range(file_number):
-                        self.partial_index_names.append(
-                            f'{self.directory}/{end_offset}_{i}')
-                os.remove(file_number_path)
-
-                reply_to_index_part_path = f'{self.directory}/' \
-                    f'{end_offset}_reply_to_index.pickle'
-                with open(reply_to_index_part_path, mode='rb') as f:
-                    reply_to_index_part = pickle.load(f)
-                    for key, value in reply_to_index_part.items():
-                        if key not in reply_to_index.keys():
-                            reply_to_index[key] = value
-                        else:
-                            reply_to_index[key].extend(value)
-                os.remove(reply_to_index_part_path)
-
-                cid_to_offset_part_path = f'{self.directory}/' \
-                    f'{end_offset}_cid_to_offset.pickle'
-                with open(cid_to_offset_part_path, mode='rb') as f:
-                    cid_to_offset_part = pickle.load(f)
-                    cid_to_offset.update(cid_to_offset_part)
-                os.remove(cid_to_offset_part_path)
-
-            with open(f'{self.directory}/reply_to_index.pickle',
-                      mode='wb') as f:
-                pickle.dump(reply_to_index, f, pickle.HIGHEST_PROTOCOL)
-
-            tempa = numpy.array([])
-            ret = []
-            ret2 = []
-            for key in sorted(cid_to_offset.keys()):
-                ret.append(numpy.int64(key))
-                ret2.append(numpy.int64(cid_to_offset[key]))
-            tempa = numpy.array(ret)
-            numpy.save(f'{self.directory}/cids.npy', tempa)
-            tempa2 = numpy.array(ret2)
-            numpy.save(f'{self.directory}/comment_offsets_cid.npy', tempa2)
+                chunks = ((self.directory, segment_directory, chunk_start,
+                           chunk_end) for chunk_start, chunk_end
+                          in zip(offsets, offsets[1:]))
+                for i, partial_result in enumerate(pool.imap_unordered(
+                        process_comments_chunk, chunks), 1):
+                    partial_results.append(partial_result)
+                    print(f'{i}/{len(offsets) - 1} chunks processed')
+
+            # partial indices have to be merged in order of their comments
+            partial_results.sort(key=lambda partial_result: partial_result[0])
+            partial_index_names = []
+            for partial_result in partial_results:
+                partial_index_names.extend(partial_result[1])
+            comment_infos = numpy.concatenate(
+                [partial_result[2] for partial_result in partial_results],
+                axis=1)
+            words = {}
+            for partial_result in partial_results:
+                words.update(partial_result[4])
 
         # merge indices
         with self.report.measure('merging index'):
             # comment term counts
-            self.comment_term_count_dict = {}
-            for file_prefix in self.partial_index_names:
-                file_path = file_prefix + '_comment_term_count_dict.pickle'
-                with open(file_path, mode='rb') as f:
-                    self.comment_term_count_dict.update(pickle.load(f))
-                os.remove(file_path)
-            tempa = numpy.array([])
-            ret = []
-            ret2 = []
-            for key in sorted(self.comment_term_count_dict.keys()):
-                ret.append(numpy.int64(key))
-                ret2.append(numpy.int32(self.comment_term_count_dict[key]))
-            tempa = numpy.array(ret)
-            numpy.save(f'{self.directory}/comment_offsets.npy', tempa)
-            tempa2 = numpy.array(ret2)
-            numpy.save(f'{self.directory}/comment_term_counts.npy', tempa2)
-
-            # collection term count
-            self.collection_term_count = 0
-            for file_prefix in self.partial_index_names:
-                file_path = file_prefix + '_collection_term_count.pickle'
-                with open(file_path, mode='rb') as f:
-                    self.collection_term_count += pickle.load(f)
+            comment_term_counts = []
+            for file_prefix in partial_index_names:
+                file_path = file_prefix + '_comment_term_counts.npy'
+                comment_term_counts.append(numpy.load(file_path))
                 os.remove(file_path)
-
-            with open(f'{self.directory}/collection_term_count.pickle',
-                      mode='wb') as f:
-                pickle.dump(self.collection_term_count,
-                            f, pickle.HIGHEST_PROTOCOL)
+            comment_term_counts = numpy.concatenate(
+                comment_term_counts, axis=1)
+            # comments are identified by dense doc ids in order of their
+            # offsets, comment_offsets maps doc ids to offsets
+            comment_offsets = comment_term_counts[0]
+            assert(numpy.array_equal(comment_offsets, comment_infos[1]))
+
+            self.save_segment_arrays(
+                segment_directory, comment_offsets, comment_term_counts[1],
+                comment_infos[0], comment_infos[2])
+            StoredFields.concatenate_stored_fields(
+                segment_directory, [partial_result[3]
+                                    for partial_result in partial_results])
+            for partial_result in partial_results:
+                os.remove(partial_result[3][0])
 
             # index
-            index_files = []
-            for file_prefix in self.partial_index_names:
-                file_path = file_prefix + '_index.csv'
-                index_files.append(open(file_path, mode='rb'))
-
-            current_terms = []
-            current_meta = []
-            current_posting_lists = []
-            global_active_indices = []
-            global_active_file_count = 0
-
-            for file in index_files:
-                line = file.readline().decode('utf-8').rstrip('\n').split(
-                    posting_list_separator, 2)
-                current_terms.append(line[0])
-                current_meta.append(int(line[1]))
-                current_posting_lists.append(line[2])
-                global_active_indices.append(True)
-                global_active_file_count += 1
-
-            current_active_indices = []
-            current_min_term = None
-            self.seek_list = []
-            current_offset = 0
-            terms_done = 0
-
-            with open(f'{self.directory}/index.csv', mode='wb') as f:
-                while global_active_file_count > 0:
-                    # find next term to write
-                    for key, term in enumerate(current_terms):
-                        if not global_active_indices[key]:
-                            continue
-                        if current_min_term is None or term < current_min_term:
-                            current_active_indices = [key]
-                            current_min_term = term
-                        elif term == current_min_term:
-                            current_active_indices.append(key)
-
-                    # merge all lines containing term
-
-                    if len(current_min_term) <= 128:
-                        meta = 0
-                        for key in current_active_indices:
-                            meta += current_meta[key]
-
-                        line_string = \
-                            f'{current_min_term}{posting_list_separator}{meta}'
-                        for key in current_active_indices:
-                            line_string += f'{posting_list_separator}' \
-                                f'{current_posting_lists[key]}'
-
-                        line_string += '\n'
-                        line_raw = line_string.encode()
-                        f.write(line_raw)
-                        term = current_min_term[1:-1].replace('""', '"')
-                        self.seek_list.append((term, [current_offset]))
-                        current_offset += len(line_raw)
-
-                    # reload lines where necessary
-                    for key in current_active_indices:
-                        linetest = index_files[key].readline().decode('utf-8')
-                        if linetest == '':
-                            # end of file
-                            global_active_indices[key] = False
-                            global_active_file_count -= 1
-                            print('one file out, '
-                                  f'{global_active_file_count} remaining')
-                        else:
-                            line = linetest.rstrip('\n').split(
-                                posting_list_separator, 2)
-                            current_terms[key] = line[0]
-                            current_meta[key] = int(line[1])
-                            current_posting_lists[key] = line[2]
-
-                    current_min_term = None
-                    current_active_indices = []
-                    terms_done += 1
-                    if terms_done % 100000 == 0:
-                        print(f'Merged {terms_done} terms.')
-
-            self.seek_list = RecordDAWG('>Q', self.seek_list)
-            self.seek_list.save(f'{self.directory}/seek_list.dawg')
-
-            for f in index_files:
-                f.close()
-
-            for file_prefix in self.partial_index_names:
-                file_path = file_prefix + '_index.csv'
-                os.remove(file_path)
-
-        self.huffman_compression(generate_encoding=False)
-
+            run_file_paths = self.merge_runs(
+                segment_directory, [file_prefix + '_index.run'
+                                    for file_prefix in partial_index_names])
+            self.save_posting_lists(segment_directory, run_posting_lists(
+                run_file_paths, comment_offsets), words)
+            for run_file_path in run_file_paths:
+                os.remove(run_file_path)
+
+        segment_info = {'name': segment_name, 'start_offset': start_offset,
+                        'end_offset': end_offset,
+                        'document_count': len(comment_offsets),
+                        'deleted_docs': None, 'deleted_count': 0}
+        is_deleted = self.find_deleted_docs(comment_offsets, comment_infos[0])
+        if is_deleted.any():
+            self.set_deleted_docs(segment_info, is_deleted, 0)
+        return segment_info
+
+    def save_string_tables(self):
         with self.report.measure('processing authors & articles'):
-            with open(f'{self.directory}/authors_list.pickle', mode='wb') as f:
-                pickle.dump(
-                    create_list_from_csv(f'{self.directory}/authors.csv'),
-                    f, pickle.HIGHEST_PROTOCOL)
-
-            with open(f'{self.directory}/articles_list.pickle', mode='wb') \
-                    as f:
-                pickle.dump(
-                    create_list_from_csv(f'{self.directory}/articles.csv'),
-                    f, pickle.HIGHEST_PROTOCOL)
-
-    def huffman_compression(self, generate_encoding=False):
-        # compress using Huffman encoding
-        symbol_to_encoding_dict = {}
-
-        # count all occuring UTF-8 characters
-        if generate_encoding:
-            symbol_to_frequency_dict = Counter()
-            with self.report.measure('counting utf8 characters'):
-                with open(f'{self.directory}/index.csv') as index_file:
-                    chunk_size = 100000
-
-                    def next_chunk_generator():
-                        chunk = index_file.read(chunk_size)
-                        while chunk:
-                            yield chunk
-                            chunk = index_file.read(chunk_size)
-
-                    for i, chunk in enumerate(next_chunk_generator(), 1):
-                        symbol_to_frequency_dict.update(Counter(chunk))
-                        self.report.progress(
-                            i, f' chunks counted ({chunk_size} characters '
-                            'each)', 100)
-                if '\n' in symbol_to_frequency_dict.keys():
-                    del symbol_to_frequency_dict['\n']
-
-            # derive huffman encoding from character counts
-            with self.report.measure('deriving huffman encoding'):
-                symbol_to_encoding_dict = Huffman.derive_encoding(
-                    symbol_to_frequency_dict)
-            for key, value in symbol_to_encoding_dict.items():
-                assert(len(key) == 1)
-                symbol_to_encoding_list[ord(key[0])] = value
-            with open(f'{self.directory}/symbol_to_encoding_dict.pickle',
-                      mode='wb') as f:
-                pickle.dump(symbol_to_encoding_dict, f,
-                            pickle.HIGHEST_PROTOCOL)
-        else:
-            # optimal encoding for guardian
-            # character distribution should be similar for all datasets
-            symbol_to_encoding_dict = {
-                '\a': BitArray('1111'), ',': BitArray('001'),
-                '0': BitArray('1000'), '1': BitArray('011'),
-                '2': BitArray('010'), '3': BitArray('000'),
-                '4': BitArray('1110'), '5': BitArray('1101'),
-                '6': BitArray('1100'), '7': BitArray('1011'),
-                '8': BitArray('1010'), '9': BitArray('1001')
-            }
-
-        with open(f'{self.directory}/symbol_to_encoding_dict.pickle',
-                  mode='wb') as f:
-            pickle.dump(symbol_to_encoding_dict, f, pickle.HIGHEST_PROTOCOL)
-
-        # save compressed index and corresponding seek_list
-        with self.report.measure('saving compressed files'):
-            self.compressed_seek_list = []
-            with open(f'{self.directory}/compressed_index', mode='wb') \
-                    as compressed_index_file:
-                offset = 0
-                for i, orig_line in enumerate(binary_read_line_generator_path(
-                        f'{self.directory}/index.csv'), 1):
-                    term = next(csv.reader(io.StringIO(orig_line),
-                                delimiter=posting_list_separator))[0]
-                    line_without_term = orig_line[len(term) + 3:]
-                    encoded_line = Huffman.encode(
-                        line_without_term, symbol_to_encoding_dict)
-                    compressed_index_file.write(encoded_line)
-
-                    self.compressed_seek_list.append(
-                        (term, (offset, len(encoded_line))))
-
-                    self.report.progress(i, ' index lines compressed', 100000)
-
-                    offset += len(encoded_line)
-            self.compressed_seek_list = \
-                RecordDAWG('>QQ', self.compressed_seek_list)
-            self.compressed_seek_list.save(
-                f'{self.directory}/compressed_seek_list.dawg')
+            save_string_table(
+                f'{self.directory}/authors',
+                create_list_from_csv(f'{self.directory}/authors.csv'))
+
+            save_string_table(
+                f'{self.directory}/articles',
+                create_list_from_csv(f'{self.directory}/articles.csv'))
+
+    # saves all arrays of a segment except the posting lists
+    # comment_cids and comment_parent_cids: cids and parent cids of the
+    # comments in order of the doc ids, -1 for no parent
+    def save_segment_arrays(self, segment_directory, comment_offsets,
+                            comment_term_counts, comment_cids,
+                            comment_parent_cids):
+        numpy.save(f'{segment_directory}/comment_offsets.npy', comment_offsets)
+        numpy.save(f'{segment_directory}/comment_term_counts.npy',
+                   comment_term_counts.astype(numpy.int32))
+        numpy.save(f'{segment_directory}/comment_cids.npy', comment_cids)
+        # cids with corresponding doc ids, sorted by cid
+        cid_doc_ids = numpy.argsort(comment_cids, kind='stable')
+        numpy.save(f'{segment_directory}/cids.npy', comment_cids[cid_doc_ids])
+        numpy.save(f'{segment_directory}/cid_doc_ids.npy', cid_doc_ids)
+        self.save_reply_to_index(
+            segment_directory, comment_cids, comment_parent_cids)
+        numpy.save(f'{segment_directory}/collection_term_count.npy',
+                   numpy.array(int(comment_term_counts.sum())))
+
+    # the replies to reply_to_parent_cids[i] are reply_to_cids[
+    # reply_to_offsets[i]:reply_to_offsets[i + 1]] in order of the comments,
+    # reply_to_doc_ids holds their doc ids
+    # comment_parent_cids maps doc ids to parent cids, -1 for no parent
+    def save_reply_to_index(self, segment_directory, comment_cids,
+                            comment_parent_cids):
+        is_reply = comment_parent_cids != -1
+        reply_to_pairs = numpy.array([comment_parent_cids[is_reply],
+                                      comment_cids[is_reply]],
+                                     dtype=numpy.int64)
+        order = numpy.argsort(reply_to_pairs[0], kind='stable')
+        parent_cids, reply_counts = numpy.unique(
+            reply_to_pairs[0][order], return_counts=True)
+        reply_to_offsets = numpy.zeros(len(parent_cids) + 1, dtype=numpy.int64)
+        numpy.cumsum(reply_counts, out=reply_to_offsets[1:])
+        numpy.save(f'{segment_directory}/reply_to_parent_cids.npy',
+                   parent_cids)
+        numpy.save(f'{segment_directory}/reply_to_offsets.npy',
+                   reply_to_offsets)
+        numpy.save(f'{segment_directory}/reply_to_cids.npy',
+                   reply_to_pairs[1][order])
+        numpy.save(f'{segment_directory}/reply_to_doc_ids.npy',
+                   numpy.flatnonzero(is_reply)[order])
+        numpy.save(f'{segment_directory}/comment_parent_cids.npy',
+                   numpy.asarray(comment_parent_cids, dtype=numpy.int64))
+
+    # merges the sorted runs until at most max_open_runs are left, consecutive
+    # runs are merged into intermediate runs, returns the remaining runs
+    def merge_runs(self, segment_directory, run_file_paths,
+                   max_open_runs=256):
+        level = 0
+        while len(run_file_paths) > max_open_runs:
+            merged_run_file_paths = []
+            for i in range(0, len(run_file_paths), max_open_runs):
+                merged_run_file_path = \
+                    f'{segment_directory}/merged_{level}_{i}_index.run'
+                with open(merged_run_file_path, mode='wb',
+                          buffering=write_buffer_size) as f:
+                    for stem, term_count, document_count, run_postings in \
+                            merge_run_files(
+                                run_file_paths[i:i + max_open_runs]):
+                        postings = run_postings[0][0] \
+                            if len(run_postings) == 1 else \
+                            Postings.encode_postings(
+                                *concatenate_run_postings(run_postings))
+                        write_run_record(f, stem, term_count, document_count,
+                                         postings)
+                for run_file_path in run_file_paths[i:i + max_open_runs]:
+                    os.remove(run_file_path)
+                merged_run_file_paths.append(merged_run_file_path)
+            run_file_paths = merged_run_file_paths
+            level += 1
+        return run_file_paths
+
+    # writes binary_index and binary_seek_list.dawg of a segment
+    # posting_lists: iterable of stem, doc ids, term frequencies and positions
+    # in order of the stems
+    # words: dict of the words of the comments to their stems for the k-gram
+    # index
+    def save_posting_lists(self, segment_directory, posting_lists, words):
+        seek_list = []
+        prefix_postings = Postings.PrefixPostings()
+        offset = 0
+        with open(f'{segment_directory}/binary_index', mode='wb',
+                  buffering=write_buffer_size) as f:
+            for i, (stem, doc_ids, term_frequencies, positions) in \
+                    enumerate(posting_lists, 1):
+                encoded_posting_list = Postings.encode_posting_list(
+                    doc_ids, term_frequencies, positions)
+                f.write(encoded_posting_list)
+                seek_list.append(
+                    (stem, (offset, len(encoded_posting_list), len(doc_ids),
+                            len(positions), int(term_frequencies.max()))))
+                offset += len(encoded_posting_list)
+                prefix_postings.add(stem, doc_ids)
+                self.report.progress(i, ' terms merged', 100000)
+        KGramIndex.save_kgram_index(
+            segment_directory, [stem for stem, _ in seek_list], words)
+        seek_list = RecordDAWG(Postings.seek_list_format, seek_list)
+        seek_list.save(f'{segment_directory}/binary_seek_list.dawg')
+        prefix_postings.save(segment_directory)
+
+    # log merge policy: segments are assigned levels by the logarithm of the
+    # number of their comments which are not deleted to the base merge_factor,
+    # as soon as merge_factor adjacent segments share a level they are merged
+    # into a segment of the next level, so every comment is merged only about
+    # log(comment count) times
+    # returns the start and stop index of the segments to merge or None
+    def find_segments_to_merge(self, segments, merge_factor=10,
+                               min_segment_size=1000):
+        levels = [get_merge_level(
+            segment['document_count'] - segment.get('deleted_count', 0),
+            merge_factor, min_segment_size) for segment in segments]
+        for start in range(len(levels) - merge_factor + 1):
+            if len(set(levels[start:start + merge_factor])) == 1:
+                return start, start + merge_factor
+        return None
+
+    # merges segments until the merge policy finds nothing to merge, search
+    # engines keep using the old segments until the merged one is complete
+    def merge_segments(self, merge_factor=10, min_segment_size=1000):
+        with self.merge_lock:
+            while True:
+                with self.segment_infos_lock:
+                    segment_infos = load_segment_infos(
+                        self.directory)['segments']
+                    segments_to_merge = self.find_segments_to_merge(
+                        segment_infos, merge_factor, min_segment_size)
+                    if segments_to_merge is None:
+                        return
+                    segment_infos = segment_infos[slice(*segments_to_merge)]
+                    segments = [Segment(
+                        f'{self.directory}/{segment_info["name"]}',
+                        segment_info.get('deleted_docs'))
+                        for segment_info in segment_infos]
+                with self.report.measure(
+                        f'merging {len(segments)} segments'):
+                    merged_segment = self.merge_segment_files(
+                        segment_infos, segments)
+
+                with self.segment_infos_lock:
+                    live_segment_infos = {
+                        segment_info['name']: segment_info for segment_info
+                        in load_segment_infos(self.directory)['segments']}
+                    if not all(segment_info['name'] in live_segment_infos
+                               for segment_info in segment_infos):
+                        # the index was rebuilt in the meantime
+                        shutil.rmtree(
+                            f'{self.directory}/{merged_segment["name"]}')
+                        continue
+                    self.apply_deletions_during_merge(segments, [
+                        live_segment_infos[segment_info['name']]
+                        for segment_info in segment_infos], merged_segment)
+                    self.replace_segments(
+                        [segment_info['name']
+                         for segment_info in segment_infos],
+                        [merged_segment])
+
+    # merges the given adjacent segments into a new segment without their
+    # deleted docs and returns its segment info
+    def merge_segment_files(self, segment_infos, segments):
+        segment_name = self.create_segment_directory()
+        segment_directory = f'{self.directory}/{segment_name}'
+        is_live = [segment.get_is_live() for segment in segments]
+        # maps the doc ids of a segment to the ones of its live docs
+        live_doc_id_maps = [numpy.cumsum(segment_is_live) - 1
+                            for segment_is_live in is_live]
+        doc_id_bases = numpy.zeros(len(segments) + 1, dtype=numpy.int64)
+        numpy.cumsum([segment_is_live.sum() for segment_is_live in is_live],
+                     out=doc_id_bases[1:])
+
+        self.save_segment_arrays(
+            segment_directory, *(numpy.concatenate([
+                numpy.asarray(segment_array)[segment_is_live]
+                for segment_array, segment_is_live in zip(arrays, is_live)])
+                for arrays in (
+                    [segment.comment_offsets for segment in segments],
+                    [segment.comment_term_counts for segment in segments],
+                    [segment.comment_cids for segment in segments],
+                    [segment.comment_parent_cids for segment in segments])))
+        stored_fields_writer = StoredFields.StoredFieldsWriter(
+            f'{segment_directory}/stored_fields')
+        for segment, segment_is_live in zip(segments, is_live):
+            for record in segment.stored_fields.iterate_records(
+                    numpy.flatnonzero(segment_is_live)):
+                stored_fields_writer.add(record)
+        StoredFields.save_stored_field_blocks(
+            segment_directory, *stored_fields_writer.close())
+        # words stay in the k-gram index as long as their stems are indexed
+        words = {}
+        for segment in segments:
+            words.update(segment.kgram_index.get_words())
+        self.save_posting_lists(segment_directory, segment_posting_lists(
+            segments, doc_id_bases, live_doc_id_maps), words)
+
+        return {'name': segment_name,
+                'start_offset': segment_infos[0]['start_offset'],
+                'end_offset': segment_infos[-1]['end_offset'],
+                'document_count': int(doc_id_bases[-1]),
+                'deleted_docs': None, 'deleted_count': 0}
+
+    # comments deleted while segments were merged are marked as deleted in
+    # the merged segment
+    # segments: the merged segments with the deleted docs used for merging
+    # segment_infos: the current segment infos of these segments
+    def apply_deletions_during_merge(self, segments, segment_infos,
+                                     merged_segment_info):
+        if all(segment.deleted_docs_file_name == segment_info.get(
+                'deleted_docs') for segment, segment_info
+                in zip(segments, segment_infos)):
+            return
+        is_deleted = []
+        for segment, segment_info in zip(segments, segment_infos):
+            is_live = segment.get_is_live()
+            is_deleted.append(load_deleted_docs(
+                f'{self.directory}/{segment_info["name"]}',
+                segment_info)[is_live])
+        self.set_deleted_docs(merged_segment_info,
+                              numpy.concatenate(is_deleted), 0)
 
 
 if __name__ == '__main__':
     data_directory = 'data/fake' if len(sys.argv) < 2 else sys.argv[1]
+    number_of_processes = None if len(sys.argv) < 3 else int(sys.argv[2])
     index_creator = IndexCreator(data_directory)
-    index_creator.create_index()
+    # IndexCreator.py data_directory [number_of_processes]
+    # [update | delete cid...]
+    if len(sys.argv) >= 4 and sys.argv[3] == 'update':
+        index_creator.update_index(number_of_processes)
+    elif len(sys.argv) >= 4 and sys.argv[3] == 'delete':
+        index_creator.delete_comments([int(cid) for cid in sys.argv[4:]])
+    else:
+        index_creator.create_index(number_of_processes)
     index_creator.report.all_time_measures()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import re
+
+import numpy
+from dawg import RecordDAWG
+
+from Common import *
+
+# wildcard patterns are matched against the words of a segment as they occur
+# in its comments, since users write patterns like euro*zone for words, not
+# for their stems like eurozon, matching words are mapped to their stems
+# an index from the k-grams of each word, marked with boundary at both ends,
+# to the ids of the words containing them, word ids are indices into the
+# sorted words
+k = 3
+boundary = '$'
+# record format of the k-gram seek list:
+# (index of the first word id in kgram_word_ids.npy, number of word ids)
+kgram_seek_list_format = '>QQ'
+
+
+def get_kgrams(text):
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+# returns the k-grams every stem matching pattern contains, an empty set if
+# pattern has no fixed part of at least k characters
+def get_pattern_kgrams(pattern):
+    return set().union(*(get_kgrams(part) for part in
+                         f'{boundary}{pattern}{boundary}'.split('*')))
+
+
+# stems: sorted list of all stems of a segment, words: dict of the words of
+# its comments to their stems, words of other stems are left out
+def save_kgram_index(directory, stems, words):
+    stem_ids = {stem: stem_id for stem_id, stem in enumerate(stems)}
+    word_stems = words
+    words = sorted(word for word, stem in word_stems.items()
+                   if stem in stem_ids)
+    kgram_word_ids = {}
+    for word_id, word in enumerate(words):
+        for kgram in get_kgrams(f'{boundary}{word}{boundary}'):
+            kgram_word_ids.setdefault(kgram, []).append(word_id)
+    seek_list = []
+    word_id_count = 0
+    for kgram, word_ids in kgram_word_ids.items():
+        seek_list.append((kgram, (word_id_count, len(word_ids))))
+        word_id_count += len(word_ids)
+    RecordDAWG(kgram_seek_list_format, seek_list).save(
+        f'{directory}/kgram_seek_list.dawg')
+    numpy.save(f'{directory}/kgram_word_ids.npy', numpy.array(
+        [word_id for word_ids in kgram_word_ids.values()
+         for word_id in word_ids], dtype=numpy.int32))
+    numpy.save(f'{directory}/word_stem_ids.npy', numpy.array(
+        [stem_ids[word_stems[word]] for word in words], dtype=numpy.int32))
+    save_string_table(f'{directory}/words', words)
+    save_string_table(f'{directory}/stems', stems)
+
+
+class KGramIndex():
+    def __init__(self, directory):
+        self.seek_list = RecordDAWG(kgram_seek_list_format)
+        self.seek_list.load(f'{directory}/kgram_seek_list.dawg')
+        self.word_ids = numpy.load(
+            f'{directory}/kgram_word_ids.npy', mmap_mode='r')
+        self.word_stem_ids = numpy.load(
+            f'{directory}/word_stem_ids.npy', mmap_mode='r')
+        self.words = StringTable(f'{directory}/words')
+        self.stems = StringTable(f'{directory}/stems')
+
+    def get_word_ids(self, kgram):
+        if kgram not in self.seek_list:
+            return numpy.zeros(0, dtype=numpy.int32)
+        start, count = self.seek_list[kgram][0]
+        return self.word_ids[start:start + count]
+
+    # returns a dict of all words to their stems, for merging segments
+    def get_words(self):
+        return {self.words[word_id]: self.stems[stem_id] for word_id, stem_id
+                in enumerate(self.word_stem_ids.tolist())}
+
+    # returns the sorted stems of the words matching pattern, in which *
+    # stands for any number of characters
+    # the words containing all k-grams of pattern are only candidates, the
+    # k-grams may be in the wrong order or overlap a *
+    def get_matching_stems(self, pattern):
+        kgram_word_ids = sorted((self.get_word_ids(kgram)
+                                 for kgram in get_pattern_kgrams(pattern)),
+                                key=len)
+        if len(kgram_word_ids) == 0:  # no fixed part to look up
+            candidates = numpy.arange(len(self.words))
+        else:
+            candidates = kgram_word_ids[0]
+            for word_ids in kgram_word_ids[1:]:
+                candidates = numpy.intersect1d(
+                    candidates, word_ids, assume_unique=True)
+        pattern_regex = re.compile('.*'.join(
+            re.escape(part) for part in pattern.split('*')))
+        stem_ids = {int(self.word_stem_ids[word_id])
+                    for word_id in numpy.asarray(candidates).tolist()
+                    if pattern_regex.fullmatch(self.words[word_id])}
+        return [self.stems[stem_id] for stem_id in sorted(stem_ids)]
+
+
+if __name__ == '__main__':
+    import tempfile
+    import Stemmer
+    stemmer = Stemmer.Stemmer('english')
+    words = ['brexit', 'eurozone', 'euro', 'organization', 'organize',
+             'realization', 'zone', 'zones']
+    with tempfile.TemporaryDirectory() as directory:
+        save_kgram_index(directory, sorted(set(stemmer.stemWords(words))),
+                         dict(zip(words, stemmer.stemWords(words))))
+        kgram_index = KGramIndex(directory)
+        assert(kgram_index.get_matching_stems('euro*zone') == ['eurozon'])
+        assert(kgram_index.get_matching_stems('*ization') == [
+            'organiz', 'realiz'])
+        assert(kgram_index.get_matching_stems('*zone') == ['eurozon', 'zone'])
+        assert(kgram_index.get_matching_stems('*rex*') == ['brexit'])
+        assert(kgram_index.get_matching_stems('*z*') == [
+            'eurozon', 'organiz', 'realiz', 'zone'])
+        assert(kgram_index.get_words()['zones'] == 'zone')
+        print('ok')
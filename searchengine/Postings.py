@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+
+import numpy
+from dawg import RecordDAWG
+
+import VarByte
+
+# record format of the seek list:
+# (offset into posting file, size in bytes, document_count, term_count,
+#  maximum term frequency within a single comment)
+seek_list_format = '>QQQQQ'
+# record format of the prefix seek list:
+# (index of the first doc id in prefix_doc_ids.npy, number of doc ids)
+prefix_seek_list_format = '>QQ'
+
+
+class PostingList():
+    # doc_ids: ascending doc ids of all comments containing the stem
+    # term_frequencies: number of occurrences of the stem per comment
+    # positions: token positions of all occurrences, grouped by comment
+    def __init__(self, doc_ids, term_frequencies, positions):
+        self.doc_ids = doc_ids
+        self.term_frequencies = term_frequencies
+        self.positions = positions
+        self.position_starts = numpy.zeros(
+            len(term_frequencies) + 1, dtype=numpy.int64)
+        numpy.cumsum(term_frequencies, out=self.position_starts[1:])
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    # memory used by the arrays in bytes
+    @property
+    def nbytes(self):
+        return self.doc_ids.nbytes + self.term_frequencies.nbytes \
+            + self.positions.nbytes + self.position_starts.nbytes
+
+    # returns the term frequencies of the sorted array doc_ids,
+    # 0 for doc ids not contained in the posting list
+    def term_frequencies_of(self, doc_ids):
+        if len(self.doc_ids) == 0:
+            return numpy.zeros(len(doc_ids), dtype=numpy.int64)
+        indices = numpy.searchsorted(self.doc_ids, doc_ids)
+        indices[indices == len(self.doc_ids)] = 0
+        return numpy.where(self.doc_ids[indices] == doc_ids,
+                           self.term_frequencies[indices], 0)
+
+    def positions_of(self, index):
+        return self.positions[
+            self.position_starts[index]:self.position_starts[index + 1]]
+
+    # returns the posting list of the comments marked in is_selected
+    def select(self, is_selected):
+        return PostingList(
+            self.doc_ids[is_selected], self.term_frequencies[is_selected],
+            self.positions[numpy.repeat(is_selected, self.term_frequencies)])
+
+    # returns the posting list of the comments in the sorted array doc_ids
+    def postings_of(self, doc_ids):
+        return self.select(numpy.isin(self.doc_ids, doc_ids,
+                                      assume_unique=True))
+
+    # returns the sorted keys doc_id << 32 | (position - offset) of all
+    # occurrences at a position of at least offset, occurrences of terms
+    # following each other in a phrase get equal keys when the offset is
+    # the position of the term in the phrase
+    def position_keys(self, offset=0):
+        is_after_offset = self.positions >= offset
+        return (numpy.repeat(self.doc_ids, self.term_frequencies)[
+            is_after_offset] << 32) | \
+            (self.positions[is_after_offset] - offset)
+
+    def __repr__(self):
+        return f'PostingList({self.doc_ids}, ' \
+            f'{self.term_frequencies}, {self.positions})'
+
+
+# posting lists are split into blocks of block_size comments, each block
+# consists of three variable byte encoded sections:
+# delta encoded doc ids | term frequencies |
+# token positions, delta encoded per comment
+# the skip table in front of the blocks holds one fixed size entry per block,
+# so single blocks can be decoded without touching the rest of the list
+block_size = 128
+skip_entry_dtype = numpy.dtype([
+    ('last_doc_id', '<u4'),  # last doc id in block
+    ('doc_ids_size', '<u4'),  # size of the first section in bytes
+    ('block_end', '<u4'),  # end of the block relative to the first block
+    ('max_term_frequency', '<u4')])  # upper bound for scores in the block
+
+
+def block_count(document_count):
+    return (document_count + block_size - 1) // block_size
+
+
+# positions are delta encoded separately for each comment
+def delta_encode_positions(term_frequencies, positions):
+    position_gaps = numpy.diff(positions, prepend=0)
+    comment_starts = numpy.cumsum(term_frequencies) - term_frequencies
+    position_gaps[comment_starts] = positions[comment_starts]
+    return position_gaps
+
+
+def delta_decode_positions(term_frequencies, position_gaps):
+    position_sums = numpy.cumsum(position_gaps)
+    comment_starts = numpy.cumsum(term_frequencies) - term_frequencies
+    return position_sums - numpy.repeat(
+        position_sums[comment_starts] - position_gaps[comment_starts],
+        term_frequencies)
+
+
+# unblocked format used for partial indices while the index is built:
+# delta encoded doc ids | term frequencies | delta encoded positions
+def encode_postings(doc_ids, term_frequencies, positions):
+    term_frequencies = numpy.asarray(term_frequencies, dtype=numpy.int64)
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    return VarByte.delta_encode(doc_ids) + VarByte.encode(term_frequencies) \
+        + VarByte.encode(delta_encode_positions(term_frequencies, positions))
+
+
+# returns arrays of doc ids, term frequencies and positions
+def decode_postings(binary_data, document_count, term_count):
+    numbers = VarByte.decode(binary_data, 2 * document_count + term_count)
+    term_frequencies = numbers[document_count:2 * document_count]
+    return (numpy.cumsum(numbers[:document_count]), term_frequencies,
+            delta_decode_positions(
+                term_frequencies, numbers[2 * document_count:]))
+
+
+# doc_ids: ascending doc ids of all comments containing the stem
+# term_frequencies: number of occurrences of the stem per comment
+# positions: token positions of all occurrences, grouped by comment
+def encode_posting_list(doc_ids, term_frequencies, positions):
+    doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+    term_frequencies = numpy.asarray(term_frequencies, dtype=numpy.int64)
+    position_gaps = delta_encode_positions(
+        term_frequencies, numpy.asarray(positions, dtype=numpy.int64))
+    comment_starts = numpy.cumsum(term_frequencies) - term_frequencies
+    # the first gap of every block is relative to the end of the last block
+    doc_id_gaps = numpy.diff(doc_ids, prepend=0)
+
+    skip_table = numpy.zeros(
+        block_count(len(doc_ids)), dtype=skip_entry_dtype)
+    blocks = []
+    block_end = 0
+    for block_index, block_start in enumerate(
+            range(0, len(doc_ids), block_size)):
+        block_stop = min(block_start + block_size, len(doc_ids))
+        encoded_doc_ids = VarByte.encode(
+            doc_id_gaps[block_start:block_stop])
+        block = encoded_doc_ids \
+            + VarByte.encode(term_frequencies[block_start:block_stop]) \
+            + VarByte.encode(position_gaps[
+                comment_starts[block_start]:comment_starts[block_stop - 1]
+                + term_frequencies[block_stop - 1]])
+        block_end += len(block)
+        skip_table[block_index] = (
+            doc_ids[block_stop - 1], len(encoded_doc_ids),
+            block_end, term_frequencies[block_start:block_stop].max())
+        blocks.append(block)
+    return skip_table.tobytes() + b''.join(blocks)
+
+
+class EncodedPostingList():
+    # binary_data: bytes-like object holding an encoded posting list
+    def __init__(self, binary_data, document_count, term_count):
+        self.document_count = document_count
+        self.term_count = term_count
+        self.skip_table = numpy.frombuffer(
+            binary_data, dtype=skip_entry_dtype,
+            count=block_count(document_count))
+        self.blocks = memoryview(binary_data)[self.skip_table.nbytes:]
+
+    def __len__(self):
+        return self.document_count
+
+    def block_start(self, block_index):
+        return 0 if block_index == 0 \
+            else int(self.skip_table['block_end'][block_index - 1])
+
+    def block_document_count(self, block_index):
+        return min(block_size, self.document_count - block_index * block_size)
+
+    def previous_last_doc_id(self, block_index):
+        return 0 if block_index == 0 else \
+            self.skip_table['last_doc_id'][block_index - 1]
+
+    def block_doc_ids(self, block_index):
+        block_start = self.block_start(block_index)
+        return self.previous_last_doc_id(block_index) + \
+            VarByte.delta_decode(
+                self.blocks[block_start:block_start + int(
+                    self.skip_table['doc_ids_size'][block_index])],
+                self.block_document_count(block_index))
+
+    # returns doc ids and term frequencies of a single block
+    def block_postings(self, block_index):
+        block_document_count = self.block_document_count(block_index)
+        numbers = VarByte.decode(self.blocks[
+            self.block_start(block_index):
+            int(self.skip_table['block_end'][block_index])],
+            2 * block_document_count)
+        return (self.previous_last_doc_id(block_index)
+                + numpy.cumsum(numbers[:block_document_count]),
+                numbers[block_document_count:])
+
+    # returns indices of the blocks that may contain the sorted array
+    # doc_ids, len(skip_table) for doc ids behind the last one
+    def block_indices_of(self, doc_ids):
+        return numpy.searchsorted(
+            self.skip_table['last_doc_id'], doc_ids)
+
+    # returns all doc ids without decoding frequencies and positions
+    def doc_ids(self):
+        if self.document_count == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate([
+            self.block_doc_ids(block_index)
+            for block_index in range(len(self.skip_table))])
+
+    # returns the elements of the sorted array doc_ids contained in
+    # the posting list, only blocks that may contain them get decoded
+    def intersect(self, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        block_indices = self.block_indices_of(doc_ids)
+        block_indices = numpy.unique(
+            block_indices[block_indices < len(self.skip_table)])
+        if len(block_indices) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        candidates = numpy.concatenate([
+            self.block_doc_ids(block_index)
+            for block_index in block_indices.tolist()])
+        return numpy.intersect1d(
+            doc_ids, candidates, assume_unique=True)
+
+    # returns the term frequencies of the sorted array doc_ids,
+    # 0 for doc ids not contained in the posting list
+    def term_frequencies_of(self, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        term_frequencies = numpy.zeros(len(doc_ids), dtype=numpy.int64)
+        block_indices = self.block_indices_of(doc_ids)
+        block_indices = numpy.unique(
+            block_indices[block_indices < len(self.skip_table)])
+        if len(block_indices) == 0:
+            return term_frequencies
+        block_postings = [self.block_postings(block_index)
+                          for block_index in block_indices.tolist()]
+        contained_offsets = numpy.concatenate(
+            [postings[0] for postings in block_postings])
+        contained_term_frequencies = numpy.concatenate(
+            [postings[1] for postings in block_postings])
+        indices = numpy.searchsorted(contained_offsets, doc_ids)
+        indices[indices == len(contained_offsets)] = 0
+        is_contained = contained_offsets[indices] == doc_ids
+        term_frequencies[is_contained] = \
+            contained_term_frequencies[indices[is_contained]]
+        return term_frequencies
+
+    # returns for every element of the sorted array doc_ids the
+    # maximum term frequency of the block it would be contained in
+    def block_max_term_frequencies_of(self, doc_ids):
+        block_max_term_frequencies = numpy.append(
+            self.skip_table['max_term_frequency'].astype(numpy.int64), 0)
+        return block_max_term_frequencies[
+            self.block_indices_of(doc_ids)]
+
+    # returns the posting list of the comments in the sorted array doc_ids,
+    # only blocks that may contain them get decoded
+    def postings_of(self, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        block_indices = self.block_indices_of(doc_ids)
+        block_indices = numpy.unique(
+            block_indices[block_indices < len(self.skip_table)])
+        block_posting_lists = []
+        for block_index in block_indices.tolist():
+            block_document_count = self.block_document_count(block_index)
+            numbers = VarByte.decode(self.blocks[
+                self.block_start(block_index):
+                int(self.skip_table['block_end'][block_index])])
+            term_frequencies = numbers[
+                block_document_count:2 * block_document_count]
+            block_posting_lists.append(PostingList(
+                self.previous_last_doc_id(block_index)
+                + numpy.cumsum(numbers[:block_document_count]),
+                term_frequencies, delta_decode_positions(
+                    term_frequencies, numbers[2 * block_document_count:])))
+        return concatenate_posting_lists(block_posting_lists).postings_of(
+            doc_ids)
+
+    def decode(self):
+        if self.document_count == 0:
+            return PostingList(*(numpy.zeros(0, dtype=numpy.int64),) * 3)
+        numbers = VarByte.decode(
+            self.blocks, 2 * self.document_count + self.term_count)
+        doc_id_gaps = []
+        term_frequencies = []
+        position_gaps = []
+        number_index = 0
+        for block_start in range(0, self.document_count, block_size):
+            block_document_count = min(
+                block_size, self.document_count - block_start)
+            doc_id_gaps.append(numbers[
+                number_index:number_index + block_document_count])
+            number_index += block_document_count
+            block_term_frequencies = numbers[
+                number_index:number_index + block_document_count]
+            term_frequencies.append(block_term_frequencies)
+            number_index += block_document_count
+            block_term_count = int(block_term_frequencies.sum())
+            position_gaps.append(numbers[
+                number_index:number_index + block_term_count])
+            number_index += block_term_count
+
+        doc_ids = numpy.cumsum(numpy.concatenate(doc_id_gaps))
+        term_frequencies = numpy.concatenate(term_frequencies)
+        positions = delta_decode_positions(
+            term_frequencies, numpy.concatenate(position_gaps))
+        return PostingList(doc_ids, term_frequencies, positions)
+
+
+# encoded posting list which keeps its decoded form in a cache shared by all
+# posting lists, once decoded all methods work on the decoded arrays
+class CachedPostingList():
+    # cache: Cache.LRUCache, key: identifies the posting list in the cache
+    def __init__(self, encoded_posting_list, cache, key):
+        self.encoded_posting_list = encoded_posting_list
+        self.cache = cache
+        self.key = key
+        self.term_count = encoded_posting_list.term_count
+
+    def __len__(self):
+        return len(self.encoded_posting_list)
+
+    # returns the cached PostingList without decoding it, None if not cached
+    def cached(self):
+        return self.cache.get(self.key) if self.key in self.cache else None
+
+    def doc_ids(self):
+        posting_list = self.cached()
+        if posting_list is None:
+            return self.encoded_posting_list.doc_ids()
+        return posting_list.doc_ids
+
+    def intersect(self, doc_ids):
+        posting_list = self.cached()
+        if posting_list is None:
+            return self.encoded_posting_list.intersect(doc_ids)
+        return numpy.intersect1d(numpy.asarray(doc_ids, dtype=numpy.int64),
+                                 posting_list.doc_ids, assume_unique=True)
+
+    def term_frequencies_of(self, doc_ids):
+        posting_list = self.cached()
+        if posting_list is None:
+            return self.encoded_posting_list.term_frequencies_of(doc_ids)
+        return posting_list.term_frequencies_of(doc_ids)
+
+    def block_max_term_frequencies_of(self, doc_ids):
+        return self.encoded_posting_list.block_max_term_frequencies_of(
+            doc_ids)
+
+    def postings_of(self, doc_ids):
+        posting_list = self.cached()
+        if posting_list is None:
+            return self.encoded_posting_list.postings_of(doc_ids)
+        return posting_list.postings_of(doc_ids)
+
+    # the arrays of cached posting lists are shared and therefore read only
+    def decode(self):
+        posting_list = self.cache.get(self.key)
+        if posting_list is None:
+            posting_list = self.encoded_posting_list.decode()
+            for array in (posting_list.doc_ids,
+                          posting_list.term_frequencies,
+                          posting_list.positions,
+                          posting_list.position_starts):
+                array.flags.writeable = False
+            self.cache.put(self.key, posting_list, posting_list.nbytes)
+        return posting_list
+
+
+def concatenate_posting_lists(posting_lists):
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    return PostingList(*(numpy.concatenate([empty] + list(arrays)) for arrays
+                         in zip(*((posting_list.doc_ids,
+                                   posting_list.term_frequencies,
+                                   posting_list.positions)
+                                  for posting_list in posting_lists)))) \
+        if len(posting_lists) > 0 else PostingList(empty, empty, empty)
+
+
+# returns a boolean array marking the keys which have another one of
+# other_keys at most distance positions before or after them in the same
+# comment, both are sorted position keys like the ones of position_keys
+def is_near(keys, other_keys, distance):
+    # the closest other keys before and after each key are found by a merge
+    # of both sorted arrays, the sentinels are never near
+    padded_other_keys = numpy.concatenate((
+        [-distance - 1], other_keys, [numpy.iinfo(numpy.int64).max]))
+    following_keys = padded_other_keys[
+        numpy.searchsorted(other_keys, keys, side='right') + 1]
+    preceding_keys = padded_other_keys[
+        numpy.searchsorted(other_keys, keys, side='left')]
+    # distance is smaller than 2**32, so keys of different comments are
+    # never near
+    return (following_keys - keys <= distance) | \
+        (keys - preceding_keys <= distance)
+
+
+# collects the union of the doc ids of all stems sharing a short prefix, so
+# prefix queries with many expansions need not decode every posting list,
+# only prefixes of at least min_stem_count stems are kept
+# stems must be added in sorted order, then the stems of a prefix follow each
+# other and only the doc ids of the current prefix of each length are held
+class PrefixPostings():
+    def __init__(self, prefix_lengths=(2, 3), min_stem_count=64):
+        self.min_stem_count = min_stem_count
+        # prefix length -> (prefix, doc id arrays of its stems so far)
+        self.current_prefixes = {length: (None, [])
+                                 for length in prefix_lengths}
+        self.seek_list = []
+        self.doc_id_arrays = []
+        self.doc_id_count = 0
+
+    def add(self, stem, doc_ids):
+        for length, (prefix, doc_id_arrays) in \
+                self.current_prefixes.items():
+            if len(stem) < length:
+                continue
+            if stem[:length] != prefix:
+                self.finish_prefix(prefix, doc_id_arrays)
+                prefix, doc_id_arrays = stem[:length], []
+                self.current_prefixes[length] = (prefix, doc_id_arrays)
+            doc_id_arrays.append(doc_ids)
+
+    def finish_prefix(self, prefix, doc_id_arrays):
+        if len(doc_id_arrays) < self.min_stem_count:
+            return
+        doc_ids = numpy.unique(numpy.concatenate(doc_id_arrays)).astype(
+            numpy.int64)
+        self.seek_list.append((prefix, (self.doc_id_count, len(doc_ids))))
+        self.doc_id_arrays.append(doc_ids)
+        self.doc_id_count += len(doc_ids)
+
+    # writes prefix_seek_list.dawg and prefix_doc_ids.npy
+    def save(self, directory):
+        for prefix, doc_id_arrays in self.current_prefixes.values():
+            self.finish_prefix(prefix, doc_id_arrays)
+        RecordDAWG(prefix_seek_list_format, self.seek_list).save(
+            f'{directory}/prefix_seek_list.dawg')
+        numpy.save(f'{directory}/prefix_doc_ids.npy', numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.int64)] + self.doc_id_arrays))
+
+
+# removes the doc ids marked in the boolean array is_deleted
+def remove_deleted(doc_ids, is_deleted):
+    if is_deleted is None:
+        return doc_ids
+    return doc_ids[~is_deleted[doc_ids]]
+
+
+# posting list of a stem spread over several segments, the doc ids of each
+# segment are shifted by its doc id base, so all methods take and return
+# global doc ids like the ones of EncodedPostingList
+# deleted docs are never returned and have a term frequency of 0,
+# len and term_count still include them
+class SegmentedPostingList():
+    # segment_posting_lists: list of (doc_id_base, doc_id_end, posting list,
+    # boolean array of deleted doc ids or None) in ascending order of
+    # doc_id_base
+    def __init__(self, segment_posting_lists):
+        self.segment_posting_lists = segment_posting_lists
+        self.document_count = sum(len(posting_list) for _, _, posting_list, _
+                                  in segment_posting_lists)
+        self.term_count = sum(posting_list.term_count
+                              for _, _, posting_list, _
+                              in segment_posting_lists)
+
+    def __len__(self):
+        return self.document_count
+
+    # yields doc_id_base, posting list, deleted docs, the slice of the sorted
+    # array doc_ids belonging to the segment and its local doc ids
+    def split(self, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        for doc_id_base, doc_id_end, posting_list, is_deleted in \
+                self.segment_posting_lists:
+            start, stop = numpy.searchsorted(
+                doc_ids, (doc_id_base, doc_id_end))
+            yield (doc_id_base, posting_list, is_deleted, slice(start, stop),
+                   doc_ids[start:stop] - doc_id_base)
+
+    def doc_ids(self):
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [
+            doc_id_base + remove_deleted(posting_list.doc_ids(), is_deleted)
+            for doc_id_base, _, posting_list, is_deleted
+            in self.segment_posting_lists])
+
+    def intersect(self, doc_ids):
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [
+            doc_id_base + remove_deleted(
+                posting_list.intersect(local_doc_ids), is_deleted)
+            for doc_id_base, posting_list, is_deleted, _, local_doc_ids
+            in self.split(doc_ids) if len(local_doc_ids) > 0])
+
+    def term_frequencies_of(self, doc_ids):
+        term_frequencies = numpy.zeros(len(doc_ids), dtype=numpy.int64)
+        for _, posting_list, is_deleted, doc_id_slice, local_doc_ids in \
+                self.split(doc_ids):
+            segment_term_frequencies = \
+                posting_list.term_frequencies_of(local_doc_ids)
+            if is_deleted is not None:
+                segment_term_frequencies[is_deleted[local_doc_ids]] = 0
+            term_frequencies[doc_id_slice] = segment_term_frequencies
+        return term_frequencies
+
+    def block_max_term_frequencies_of(self, doc_ids):
+        block_max_term_frequencies = numpy.zeros(
+            len(doc_ids), dtype=numpy.int64)
+        for _, posting_list, _, doc_id_slice, local_doc_ids in \
+                self.split(doc_ids):
+            block_max_term_frequencies[doc_id_slice] = \
+                posting_list.block_max_term_frequencies_of(local_doc_ids)
+        return block_max_term_frequencies
+
+    # doc_id_base, segment posting list and deleted docs -> PostingList with
+    # global doc ids
+    def to_global(self, doc_id_base, posting_list, is_deleted):
+        if is_deleted is not None:
+            posting_list = posting_list.select(
+                ~is_deleted[posting_list.doc_ids])
+        return PostingList(doc_id_base + posting_list.doc_ids,
+                           posting_list.term_frequencies,
+                           posting_list.positions)
+
+    def postings_of(self, doc_ids):
+        return concatenate_posting_lists([
+            self.to_global(doc_id_base, posting_list.postings_of(
+                local_doc_ids), is_deleted)
+            for doc_id_base, posting_list, is_deleted, _, local_doc_ids
+            in self.split(doc_ids) if len(local_doc_ids) > 0])
+
+    def decode(self):
+        return concatenate_posting_lists([
+            self.to_global(doc_id_base, posting_list.decode(), is_deleted)
+            for doc_id_base, _, posting_list, is_deleted
+            in self.segment_posting_lists])
+
+
+if __name__ == '__main__':
+    doc_ids = list(range(0, 300 * 127, 127))
+    positions_list = [[i % 5, i % 5 + 3] for i in range(300)]
+    encoded = encode_posting_list(
+        doc_ids, [2] * 300, numpy.concatenate(positions_list))
+    encoded_posting_list = EncodedPostingList(encoded, 300, 600)
+    assert(encoded_posting_list.term_frequencies_of(
+        [0, 1, 127, 299 * 127, 300 * 127]).tolist() == [2, 0, 2, 2, 0])
+    posting_list = encoded_posting_list.decode()
+    print(f'encoded size: {len(encoded)} bytes')
+    print(encoded_posting_list.skip_table)
+    assert(posting_list.doc_ids.tolist() == doc_ids)
+    assert([posting_list.positions_of(i).tolist() for i in range(300)]
+           == positions_list)
+    assert(encoded_posting_list.doc_ids().tolist()
+           == doc_ids)
+    assert(encoded_posting_list.intersect([5, 127, 260 * 127]).tolist()
+           == [127, 260 * 127])
+    segmented_posting_list = SegmentedPostingList([
+        (0, 300 * 127, encoded_posting_list, None),
+        (300 * 127, 600 * 127, encoded_posting_list, None)])
+    assert(segmented_posting_list.intersect([127, 300 * 127 + 127]).tolist()
+           == [127, 300 * 127 + 127])
+    assert(segmented_posting_list.decode().doc_ids.tolist()
+           == doc_ids + [300 * 127 + doc_id for doc_id in doc_ids])
+    selected_posting_list = segmented_posting_list.postings_of(
+        [127, 128, 300 * 127 + 254])
+    assert(selected_posting_list.doc_ids.tolist() == [127, 300 * 127 + 254])
+    assert(selected_posting_list.positions.tolist() == [1, 4, 2, 5])
+    assert(selected_posting_list.position_keys(2).tolist()
+           == [127 << 32 | 2, (300 * 127 + 254) << 32 | 0,
+               (300 * 127 + 254) << 32 | 3])
+    assert(is_near(numpy.array([1 << 32 | 5, 1 << 32 | 9, 2 << 32 | 1]),
+                   numpy.array([1 << 32 | 3, 1 << 32 | 9, 2 << 32 | 8]),
+                   2).tolist() == [True, False, False])
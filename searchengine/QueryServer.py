@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import traceback
+import urllib.parse
+
+from SearchEngine import SearchEngine
+from WorkerPool import WorkerPool
+
+# long running search server keeping the index loaded, it speaks a minimal
+# HTTP/1.1 over localhost TCP or a Unix socket:
+# POST /search with a JSON object
+#   query: the query like a line of a query file
+#   offset, limit: the page of results to return, 0 and 10 by default
+#   proximity_boost: see SearchEngine.evaluate, false by default
+#   ids_only: return only cids instead of whole comments, true by default
+# answers {"query", "offset", "limit", "has_more", "results"}, results of
+# ranked queries in order of their scores
+# GET /status answers the index generation and cache statistics
+# errors are answered as {"error": message} with a 4xx or 5xx status
+# connections are handled concurrently by this process, which dispatches
+# the queries to its workers: a thread evaluating one query at a time, since
+# SearchEngine is not thread safe, or a pool of processes evaluating them in
+# parallel, the event loop keeps accepting and timing out requests meanwhile
+default_limit = 10
+max_limit = 1000
+max_body_size = 2**16
+
+status_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                  405: 'Method Not Allowed', 408: 'Request Timeout',
+                  413: 'Payload Too Large',
+                  500: 'Internal Server Error', 504: 'Gateway Timeout'}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def comment_fields(comment):
+    return {'cid': comment.cid, 'article_url': comment.article_url,
+            'author': comment.author, 'text': comment.text,
+            'timestamp': comment.timestamp, 'parent_cid': comment.parent_cid,
+            'upvotes': comment.upvotes, 'downvotes': comment.downvotes}
+
+
+def get_int(request, name, default, minimum, maximum):
+    value = request.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool) or \
+            not minimum <= value <= maximum:
+        raise RequestError(
+            400, f'{name} must be an integer from {minimum} to {maximum}')
+    return value
+
+
+# runs in a worker, returns the response to a search request
+def search(search_engine, query, offset, limit, proximity_boost, ids_only):
+    search_engine.refresh_index()
+    # one more result than requested tells whether there is a next page,
+    # ranked results of the same query with a larger top_k are computed
+    # again, but the pages before are usually requested first
+    doc_ids = search_engine.evaluate(
+        query, offset + limit + 1, proximity_boost)
+    page = doc_ids[offset:offset + limit]
+    if ids_only:
+        results = search_engine.get_comment_cids(page).tolist()
+    else:
+        results = [comment_fields(comment)
+                   for comment in search_engine.load_comments(page)]
+    return {'query': query, 'offset': offset, 'limit': limit,
+            'has_more': len(doc_ids) > offset + limit, 'results': results}
+
+
+# caches are per worker, so are their statistics
+def status(search_engine):
+    return {'worker': os.getpid(),
+            'generation': search_engine.segment_generation,
+            'documents': int(search_engine.doc_id_bases[-1]),
+            'posting_list_cache':
+                search_engine.posting_list_cache.statistics(),
+            'result_cache': search_engine.result_cache.statistics()}
+
+
+server_functions = {'search': search, 'status': status}
+
+
+# a single worker thread with the same interface as WorkerPool
+class ThreadWorker():
+    def __init__(self, search_engine, functions):
+        self.search_engine = search_engine
+        self.functions = functions
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return 1
+
+    async def run(self, function_name, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.functions[function_name],
+            self.search_engine, *args)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class QueryServer():
+    # timeout: seconds after which a search request is answered with 504,
+    # the evaluation itself cannot be interrupted and still occupies its
+    # worker, and after which a request not read completely is answered
+    # with 408, so idle clients do not hold their connections open
+    # worker_count: number of worker processes, see WorkerPool, with 1 the
+    # queries are evaluated in a thread of this process
+    # the server must be created before any event loop is started
+    def __init__(self, search_engine, timeout=10.0, worker_count=1):
+        search_engine.report.quiet_mode = True
+        self.timeout = timeout
+        if worker_count == 1:
+            self.workers = ThreadWorker(search_engine, server_functions)
+        else:
+            self.workers = WorkerPool(
+                search_engine, server_functions, worker_count)
+
+    async def run_in_worker(self, function_name, *args):
+        try:
+            return await asyncio.wait_for(
+                self.workers.run(function_name, *args), self.timeout)
+        except asyncio.TimeoutError:
+            raise RequestError(504, f'timed out after {self.timeout} sec')
+
+    def close(self):
+        self.workers.close()
+
+    async def handle_request(self, method, path, body):
+        if path == '/status':
+            if method != 'GET':
+                raise RequestError(405, 'use GET for /status')
+            return await self.run_in_worker('status')
+        if path != '/search':
+            raise RequestError(404, f'unknown path {path}')
+        if method != 'POST':
+            raise RequestError(405, 'use POST for /search')
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise RequestError(400, 'the body must be a JSON object')
+        if not isinstance(request, dict) or \
+                not isinstance(request.get('query'), str):
+            raise RequestError(400, 'query must be a string')
+        offset = get_int(request, 'offset', 0, 0, 2**31)
+        limit = get_int(request, 'limit', default_limit, 1, max_limit)
+        try:
+            return await self.run_in_worker(
+                'search', request['query'].strip(), offset, limit,
+                bool(request.get('proximity_boost', False)),
+                bool(request.get('ids_only', True)))
+        except RuntimeError as error:  # unparsable queries
+            raise RequestError(400, str(error))
+
+    # reads an HTTP request, returns (method, path, body)
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise RequestError(400, 'malformed request line')
+        content_length = 0
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if header == '':
+                break
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                if not value.strip().isdigit():
+                    raise RequestError(400, 'malformed Content-Length')
+                content_length = int(value)
+        if content_length > max_body_size:
+            raise RequestError(413, 'request body too large')
+        body = await reader.readexactly(content_length)
+        path = urllib.parse.urlsplit(request_line[1]).path
+        return request_line[0].upper(), path, body
+
+    async def handle_connection(self, reader, writer):
+        try:
+            try:
+                try:
+                    request = await asyncio.wait_for(
+                        self.read_request(reader), self.timeout)
+                except asyncio.TimeoutError:
+                    raise RequestError(
+                        408, f'request not received within {self.timeout} sec')
+                response = await self.handle_request(*request)
+                status = 200
+            except RequestError as error:
+                response = {'error': str(error)}
+                status = error.status
+            except Exception as error:
+                # the server keeps serving other requests
+                traceback.print_exc()
+                response = {'error': f'internal error: {error}'}
+                status = 500
+            body = json.dumps(response).encode()
+            writer.write(
+                f'HTTP/1.1 {status} {status_reasons[status]}\r\n'
+                'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    # serves on the Unix socket at socket_path if it is given, otherwise on
+    # host and port
+    async def serve(self, host='127.0.0.1', port=8080, socket_path=None):
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(
+                self.handle_connection, path=socket_path)
+        else:
+            server = await asyncio.start_server(
+                self.handle_connection, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', default='data/enpeople',
+                        help='the directory of the index')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', help='serve on this Unix socket instead '
+                        'of host and port')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='the number of worker processes')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds after which a search or a request '
+                        'not received completely is answered with an error')
+    args = parser.parse_args()
+
+    search_engine = SearchEngine()
+    search_engine.load_index(args.directory)
+    print('index loaded')
+    query_server = QueryServer(search_engine, args.timeout, args.workers)
+    asyncio.run(query_server.serve(args.host, args.port, args.socket))
@@ -3,46 +3,113 @@
 import re
 
 
+# malformed query tokens raise RuntimeErrors like other unparsable queries
+def check_token(condition, raw_query_token):
+    if not condition:
+        raise RuntimeError(f'malformed query token: {raw_query_token}')
+
+
+def parse_target_cid(query_token, operator, raw_query_token):
+    cid = query_token.partition(operator)[2]
+    check_token(query_token.count(operator) == 1 and
+                query_token.startswith(operator) and cid.isdigit(),
+                raw_query_token)
+    return int(cid)
+
+
 class TokenNode():
     def __init__(self, raw_query_token):
-        assert(len(raw_query_token) > 0)
+        check_token(raw_query_token.strip() != '', raw_query_token)
         self.raw_query_token = raw_query_token
-        parts = raw_query_token.strip().rpartition('NOT ')
-        self.is_negated = parts[1] == 'NOT '
-        query_token = parts[2].lower()
+        self.is_negated = False
+        query_token = raw_query_token.strip().lower()
         # self.result = []
-        if len(query_token) > 1 and query_token[-2] == "'":
-            assert(query_token[0] == "'" and query_token.count("'") == 2
-                   and query_token[-1] == '*')
+        near_match = re.fullmatch('([^ ]+) near/([0-9]+) ([^ ]+)', query_token)
+        if near_match is not None:
+            self.kind = 'near'
+            self.keywords = (near_match[1], near_match[3])
+            check_token(not any('*' in keyword or "'" in keyword
+                                for keyword in self.keywords),
+                        raw_query_token)
+            self.distance = int(near_match[2])
+            self.query_token = ' '.join(self.keywords)
+        elif len(query_token) > 1 and query_token[-2] == "'":
+            check_token(query_token[0] == "'" and query_token.count("'") == 2
+                        and query_token[-1] == '*', raw_query_token)
             self.kind = 'phrase_prefix'
             parts = query_token[1:-2].rpartition(' ')
+            check_token(parts[2] != '', raw_query_token)
             self.phrase_start = parts[0]
             self.prefix = parts[2]
             self.query_token = query_token[1:-2]
         elif query_token[-1] == "'":
-            assert(query_token[0] == "'" and query_token.count("'") == 2)
+            check_token(len(query_token) > 1 and query_token[0] == "'" and
+                        query_token.count("'") == 2, raw_query_token)
             self.kind = 'phrase'
             self.phrase = query_token[1:-1]
             self.query_token = self.phrase
-        elif query_token[-1] == '*':
-            assert(query_token.count('*') == 1)
+        elif query_token[-1] == '*' and query_token.count('*') == 1:
             self.kind = 'prefix'
             self.prefix = query_token[:-1]
+            check_token(self.prefix != '', raw_query_token)
             self.query_token = self.prefix
+        elif '*' in query_token:
+            # wildcard query: *ization, euro*zone, *brex*
+            check_token(' ' not in query_token and
+                        query_token.strip('*') != '', raw_query_token)
+            self.kind = 'wildcard'
+            self.pattern = query_token
+            self.query_token = ' '.join(
+                part for part in query_token.split('*') if part != '')
         elif 'replyto:' in query_token:
-            assert(query_token.count('replyto:') == 1 and
-                   query_token.startswith('replyto:'))
             self.kind = 'reply_to'
-            self.target_cid = int(query_token.partition('replyto:')[2])
+            self.target_cid = parse_target_cid(
+                query_token, 'replyto:', raw_query_token)
+            self.query_token = ''
+        elif 'threadof:' in query_token:
+            self.kind = 'thread_of'
+            self.target_cid = parse_target_cid(
+                query_token, 'threadof:', raw_query_token)
+            self.query_token = ''
+        elif 'descendantsof:' in query_token:
+            self.kind = 'descendants_of'
+            self.target_cid = parse_target_cid(
+                query_token, 'descendantsof:', raw_query_token)
             self.query_token = ''
         else:
-            assert(' ' not in query_token)
+            check_token(' ' not in query_token, raw_query_token)
             self.kind = 'keyword'
             self.keyword = query_token
             self.query_token = self.keyword
 
+    # returns a hashable key which is equal for tokens with equal results,
+    # stem: function stemming a single word
+    def key(self, stem):
+        if self.kind == 'phrase_prefix':
+            token_key = (self.phrase_start, self.prefix)
+        elif self.kind == 'phrase':
+            token_key = (self.phrase,)
+        elif self.kind == 'prefix':
+            token_key = (self.prefix,)
+        elif self.kind == 'wildcard':
+            token_key = (self.pattern,)
+        elif self.kind == 'keyword':
+            token_key = (stem(self.keyword),)
+        elif self.kind == 'near':  # the order of the keywords does not matter
+            token_key = tuple(sorted(map(stem, self.keywords))) \
+                + (self.distance,)
+        else:
+            token_key = (self.target_cid,)
+        return (self.is_negated, self.kind) + token_key
+
+    def get_query_terms(self):
+        if self.is_negated or self.query_token == '':
+            return []
+        return self.query_token.split(' ')
+
     def __repr__(self):
-        return f'TokenNode("{self.raw_query_token}")'
+        return f'TokenNode("{"NOT " if self.is_negated else ""}' \
+            f'{self.raw_query_token}")'
 
 
 class AndNode():
@@ -58,8 +125,18 @@ class AndNode():
         self.children = children
         self.is_negated = False
 
+    # the order and repetitions of children do not change the result
+    def key(self, stem):
+        return (self.is_negated, 'AND') + tuple(sorted(set(
+            child.key(stem) for child in self.children)))
+
+    def get_query_terms(self):
+        return [] if self.is_negated else [
+            term for child in self.children
+            for term in child.get_query_terms()]
+
     def __repr__(self):
-        return f'AndNode({self.children})'
+        return f'{"NOT " if self.is_negated else ""}AndNode({self.children})'
 
 
 class OrNode():
@@ -67,75 +144,207 @@ class OrNode():
         assert(len(children) >= 1)
 
         if next(filter(lambda child: child.is_negated, children), False):
-            raise RuntimeError('negated tokens must not be used with AND')
+            raise RuntimeError('negated tokens must not be used with OR')
 
         self.children = children
         self.is_negated = False
 
+    def key(self, stem):
+        return (self.is_negated, 'OR') + tuple(sorted(set(
+            child.key(stem) for child in self.children)))
+
+    def get_query_terms(self):
+        return [] if self.is_negated else [
+            term for child in self.children
+            for term in child.get_query_terms()]
+
     def __repr__(self):
-        return f'OrNode({self.children})'
+        return f'{"NOT " if self.is_negated else ""}OrNode({self.children})'
 
 
-# query tokens delimited by space, for non boolean queries
+# query tokens delimited by space, for non boolean queries, matches comments
+# matching any child, ranked by the query terms of all children
 class SpaceNode():
     def __init__(self, children):
         assert(len(children) >= 1)
-        self.children = children
+
+        if next(filter(lambda child: child.is_negated, children), False):
+            raise RuntimeError('negated tokens must be connected by AND')
+
+        # space nodes within space nodes like the ones of trump's match the
+        # same comments with the same terms as their children
+        self.children = [grandchild for child in children for grandchild in (
+            child.children if isinstance(child, SpaceNode) else [child])]
         self.is_negated = False
-        self.query_terms = []
-        for child in children:
-            if child.query_token != '':
-                self.query_terms.extend(child.query_token.split(' '))
+        # query terms of all non negated tokens for ranking
+        self.query_terms = [term for child in children
+                            for term in child.get_query_terms()]
+
+    def get_query_terms(self):
+        return self.query_terms
+
+    # repeated query terms weigh more in scores, so only the order of the
+    # children does not change the result, the keys of AND and OR children
+    # ignore repetitions, so the stemmed query terms are part of the key
+    def key(self, stem):
+        return (self.is_negated, 'SPACE') + tuple(sorted(
+            child.key(stem) for child in self.children)) + (
+            tuple(sorted(map(stem, self.query_terms))),)
 
     def __repr__(self):
-        return f'SpaceNode({self.children})'
+        return f'{"NOT " if self.is_negated else ""}SpaceNode({self.children})'
 
 
+# lexemes of queries: parentheses, phrases and other space delimited tokens
+# phrases start with a quote at the start of a token, words may contain
+# quotes like trump's, stray quotes are ignored
+lexeme_pattern = re.compile(
+    "[()]|(?<![^\\s(])'[^']*'\\*?|[^\\s()']+(?:'[^\\s()']+)*")
+
+
+# recursive descent parser of queries, operators from the weakest to the
+# strongest binding:
+# space: ranked match of any of the space delimited expressions
+# OR
+# AND: explicit or by NOT, a NOT b means a AND NOT b
+# NOT: prefix of a single token or expression in parentheses
+# parentheses group any expression, a keyword followed by NEAR/k and
+# another keyword forms a single token
+class QueryParser():
+    def __init__(self, query):
+        self.lexemes = lexeme_pattern.findall(query)
+        self.position = 0
+
+    def peek(self):
+        if self.position == len(self.lexemes):
+            return None
+        return self.lexemes[self.position]
+
+    def next(self):
+        lexeme = self.peek()
+        if lexeme is None:
+            raise RuntimeError('unexpected end of query')
+        self.position += 1
+        return lexeme
+
+    # returns the list of space delimited expressions up to the next ) or
+    # the end of the query
+    def parse_space(self):
+        children = []
+        while self.peek() not in (None, ')'):
+            children.append(self.parse_or())
+        if len(children) == 0:
+            raise RuntimeError('empty query or parentheses')
+        return children
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else OrNode(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek() in ('AND', 'NOT'):
+            if self.next() == 'NOT':
+                children.append(negate(self.parse_not()))
+            else:
+                children.append(self.parse_not())
+        return children[0] if len(children) == 1 else AndNode(children)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.next()
+            return negate(self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        lexeme = self.next()
+        if lexeme in (')', 'AND', 'OR'):
+            raise RuntimeError(f'unexpected {lexeme} in query')
+        if lexeme == '(':
+            children = self.parse_space()
+            if self.next() != ')':
+                raise RuntimeError('missing ) in query')
+            return children[0] if len(children) == 1 else SpaceNode(children)
+        if re.fullmatch('NEAR/[0-9]+', self.peek() or ''):
+            operator = self.next()
+            other_lexeme = self.next()
+            if other_lexeme in ('(', ')', 'AND', 'OR', 'NOT'):
+                raise RuntimeError(f'{operator} must be followed by a keyword')
+            return TokenNode(f'{lexeme} {operator} {other_lexeme}')
+        if lexeme[0] != "'" and "'" in lexeme:
+            # the quotes separate tokens in the indexed texts as well, so
+            # trump's matches like (trump s)
+            parts = lexeme.split("'")
+            return SpaceNode([TokenNode(part) for part in parts])
+        return TokenNode(lexeme)
+
+
+def negate(node):
+    node.is_negated = not node.is_negated
+    return node
+
+
+# queries with a single AND or OR expression are boolean queries, results are
+# not ranked, all other queries are ranked
 def build_query_tree(query):
-    query = query.strip()
-    root_node = None
-    if ' AND ' in query or ' OR ' in query or 'NOT ' in query:  # boolean query
-        query_list = []
-        query = re.sub('(?<! AND) NOT ', ' AND NOT ', query)
-        assert(query.count("'") % 2 == 0)
-
-        # initialize, create TokenNodes
-        for match in re.findall("([^']+)|('[^']+'\*?)", query):
-            if match[1] != '':  # second capture group ('[^']+'\*?)
-                query_list.append(TokenNode(match[1]))
-            else:  # first capture group ([^']+)
-                for query_token in re.findall('(?:NOT )?[^ ]+', match[0]):
-                    if query_token in ('AND', 'OR'):
-                        query_list.append(query_token)
-                    else:
-                        query_list.append(TokenNode(query_token))
-
-        # create AndNodes
-        query_list_AND = []
-
-        positions_OR = (i for i in range(len(query_list) + 1)
-                        if i == len(query_list) or query_list[i] == 'OR')
-        last_position_OR = -1
-        for position_OR in positions_OR:
-            list_AND = query_list[last_position_OR + 1:position_OR]
-            last_position_OR = position_OR
-            nodes_connected_by_AND = list_AND[::2]
-            query_list_AND.append(AndNode(nodes_connected_by_AND))
-        root_node = OrNode(query_list_AND)
+    parser = QueryParser(query.strip())
+    children = parser.parse_space()
+    if parser.peek() is not None:
+        raise RuntimeError('unbalanced ) in query')
+    if len(children) == 1 and children[0].is_negated:
+        raise RuntimeError('a query must not be negated as a whole')
+    if len(children) == 1 and isinstance(children[0], (AndNode, OrNode)):
+        root_node = children[0]
         root_node.is_boolean_query = True
-
-    else:  # non boolean query
-        query_list = []
-        for match in re.findall("([^']+)|('[^']+'\*?)", query):
-            if match[1] != '':  # second capture group ('[^']+'\*?)
-                query_list.append(TokenNode(match[1]))
-            else:  # first capture group ([^']+)
-                for query_token in re.findall('[^ ]+', match[0]):
-                    query_list.append(TokenNode(query_token))
-        root_node = SpaceNode(query_list)
+    else:
+        root_node = SpaceNode(children)
         root_node.is_boolean_query = False
     return root_node
 
 
+# evaluation plan of a query tree compiled by SearchEngine.compile_query
+# query_node: node of the query tree
+# children: plan nodes of the children of query_node in order of evaluation,
+# children of AND nodes which cannot match anything are left out
+# key: key of query_node, is_shared: whether the subtree occurs more than
+# once in the query, its result is then computed only once
+class PlanNode():
+    def __init__(self, query_node, key, children, is_shared):
+        self.query_node = query_node
+        self.is_negated = query_node.is_negated
+        self.key = key
+        self.children = children
+        self.is_shared = is_shared
+
+    def __repr__(self):
+        if len(self.children) == 0:
+            return f'PlanNode({self.query_node})'
+        return f'PlanNode({"NOT " if self.is_negated else ""}' \
+            f'{type(self.query_node).__name__}, {self.children}' \
+            f'{", shared" if self.is_shared else ""})'
+
+
 if __name__ == '__main__':
     print(build_query_tree("NOT merkel AND xi OR 'something something'"))
+    print(build_query_tree('trump NEAR/5 putin AND NOT merkel'))
+    print(build_query_tree(
+        "(trump OR putin) AND (election OR vote*) NOT 'fake news'"))
+    assert(build_query_tree('trump NEAR/5 Putin').key(str.lower)
+           == build_query_tree('putin NEAR/5 trump').key(str.lower))
+    assert(build_query_tree('Xi AND merkel').key(str.lower)
+           == build_query_tree('merkel AND xi AND xi').key(str.lower))
+    assert(build_query_tree('trump (putin AND eurozone)').key(str.lower)
+           != build_query_tree('trump (putin AND eurozone AND putin)').key(
+               str.lower))
+    assert(build_query_tree('trump (putin OR putin OR war)').key(str.lower)
+           != build_query_tree('trump (putin OR war)').key(str.lower))
+    assert(build_query_tree('trump (putin OR war)').key(str.lower)
+           == build_query_tree('(war OR putin) trump').key(str.lower))
+    assert(build_query_tree('merkel chancel* (xi AND trump)').query_terms
+           == ['merkel', 'chancel', 'xi', 'trump'])
+    assert(not build_query_tree('(merkel)').is_boolean_query)
+    assert(build_query_tree("trump's 'new year' tweets").query_terms
+           == ['trump', 's', 'new', 'year', 'tweets'])
@@ -1,298 +1,850 @@
 #!/usr/bin/env python3
 
-import pickle
+import os
 import math
-import heapq
 import numpy
 from sys import argv
 
 import Stemmer
 import nltk.tokenize
-from dawg import RecordDAWG
 
 from Report import Report
 from Common import *
-import Huffman
-from QueryTree import build_query_tree
+from Cache import LRUCache
+from Bitmap import Bitmap
+import Postings
+from Segment import *
+from QueryTree import *
 from IndexCreator import IndexCreator
 
 
+# estimated memory of a result cache entry besides the doc ids in bytes
+result_cache_entry_overhead = 512
+
+
+# returns indices of the top_k highest scores, highest score first,
+# ties in order of doc ids
+def rank_scores(doc_ids, scores, top_k=None):
+    if top_k is not None and len(scores) > top_k:
+        # all scores tied with the kth highest one are candidates, so ties at
+        # the cut are decided by doc ids as well
+        kth_score = numpy.partition(scores, -top_k)[-top_k]
+        top_k_indices = numpy.flatnonzero(scores >= kth_score)
+    else:
+        top_k_indices = numpy.arange(len(scores))
+    return top_k_indices[numpy.lexsort((
+        doc_ids[top_k_indices], -scores[top_k_indices]))][:top_k]
+
+
+# returns the doc ids of posting_list, only the ones in the sorted array
+# candidates unless it is None
+def restricted_doc_ids(posting_list, candidates=None):
+    if candidates is None:
+        return posting_list.doc_ids()
+    return posting_list.intersect(candidates)
+
+
 class SearchEngine():
-    def __init__(self):
-        self.seek_list = None
-        self.comment_file = None
-        self.index_file = None
-        self.symbol_to_encoding_dict = None
-        self.cids = None
-        self.comment_offsets_cid = None
-        self.comment_offsets = None
-        self.comment_term_counts = None
-        self.comment_csv_reader = None
+    # posting_list_cache_size: memory for decoded posting lists in bytes
+    # result_cache_size: memory for results of whole queries in bytes
+    # proximity_window, proximity_weight: ranked queries with proximity
+    # boosting add proximity_weight to the score of a comment for each pair of
+    # consecutive query terms at most proximity_window tokens apart in it
+    # max_prefix_stems: maximum number of stems a prefix query is expanded to
+    def __init__(self, posting_list_cache_size=2**28,
+                 result_cache_size=2**24, proximity_window=8,
+                 proximity_weight=1.0, max_prefix_stems=1000):
+        self.directory = None
+        self.segments = []
+        self.segment_generation = None
+        self.segment_infos_file_id = None
+        # doc ids of self.segments[i] are the range
+        # [doc_id_bases[i], doc_id_bases[i + 1])
+        self.doc_id_bases = numpy.zeros(1, dtype=numpy.int64)
         self.authors_list = None
         self.articles_list = None
-        self.reply_to_index = None
         self.collection_term_count = 0
+        # decoded posting lists by segment directory and stem, segments are
+        # never changed, so entries stay valid as long as their segment lives
+        self.posting_list_cache = LRUCache(posting_list_cache_size)
+        # doc ids change with every generation of segments, so the result
+        # cache is cleared whenever the generation changes
+        self.result_cache = LRUCache(result_cache_size)
+        self.proximity_window = proximity_window
+        self.proximity_weight = proximity_weight
+        self.max_prefix_stems = max_prefix_stems
         self.stemmer = Stemmer.Stemmer('english')
         self.tokenizer = nltk.tokenize.ToktokTokenizer()
         self.report = Report()
 
     def load_index(self, directory):
-        self.seek_list = RecordDAWG('>QQ')
-        self.seek_list.load(f'{directory}/compressed_seek_list.dawg')
-        self.index_file = open(f'{directory}/compressed_index', mode='rb')
-        with open(f'{directory}/symbol_to_encoding_dict.pickle',
-                  mode='rb') as f:
-            self.symbol_to_encoding_dict = pickle.load(f)
-        self.comment_offsets = numpy.load(
-            f'{directory}/comment_offsets.npy', mmap_mode=None)
-        self.comment_term_counts = numpy.load(
-            f'{directory}/comment_term_counts.npy', mmap_mode=None)
-        with open(f'{directory}/collection_term_count.pickle', mode='rb') as f:
-            self.collection_term_count = pickle.load(f)
-        self.comment_file = open(f'{directory}/comments.csv', mode='rb')
-        self.comment_csv_reader = csv.reader(
-            binary_read_line_generator(self.comment_file))
-        with open(f'{directory}/authors_list.pickle', mode='rb') as f:
-            self.authors_list = pickle.load(f)
-        with open(f'{directory}/articles_list.pickle', mode='rb') as f:
-            self.articles_list = pickle.load(f)
-        with open(f'{directory}/reply_to_index.pickle', mode='rb') as f:
-            self.reply_to_index = pickle.load(f)
-        self.cids = numpy.load(f'{directory}/cids.npy', mmap_mode='r')
-        self.comment_offsets_cid = numpy.load(
-            f'{directory}/comment_offsets_cid.npy', mmap_mode='r')
-
-    def load_posting_list_parts(self, stem):
-        offset, size = self.seek_list[stem][0]
-        self.index_file.seek(offset)
-        binary_data = self.index_file.read(size)
-        decoded_posting_list = Huffman.decode(
-            binary_data, self.symbol_to_encoding_dict)
-        return [stem] + decoded_posting_list.split(posting_list_separator)
-
-    def get_comment_term_count(self, comment_offset):
-        return self.comment_term_counts[numpy.searchsorted(
-            self.comment_offsets, comment_offset)]
-
-    def get_cid_to_offset(self, cid):
-        return self.comment_offsets_cid[numpy.searchsorted(self.cids, cid)]
-
-    # returns score based on natural language model with dirichlet smoothing
+        self.directory = directory
+        self.load_segments()
+
+    # opens the live segments of the newest generation of the index,
+    # segments which were already open before are reused
+    def load_segments(self):
+        open_segments = {(os.path.basename(segment.directory),
+                          segment.deleted_docs_file_name): segment
+                         for segment in self.segments}
+        failed_generation = None
+        while True:
+            segment_infos_path = f'{self.directory}/{segment_infos_file_name}'
+            segment_infos_stat = os.stat(segment_infos_path) \
+                if os.path.exists(segment_infos_path) else None
+            segment_infos = load_segment_infos(self.directory)
+            try:
+                segments = [
+                    open_segments.get((segment_info['name'],
+                                       segment_info.get('deleted_docs')))
+                    or Segment(f'{self.directory}/{segment_info["name"]}',
+                               segment_info.get('deleted_docs'))
+                    for segment_info in segment_infos['segments']]
+                self.authors_list = StringTable(f'{self.directory}/authors')
+                self.articles_list = StringTable(f'{self.directory}/articles')
+                break
+            except FileNotFoundError:
+                # a merge may have removed segments of this generation
+                # meanwhile, then the next generation is complete
+                if segment_infos['generation'] == failed_generation:
+                    raise
+                failed_generation = segment_infos['generation']
+
+        self.segments = segments
+        live_directories = {segment.directory for segment in segments}
+        self.posting_list_cache.discard_if(
+            lambda key: key[0] not in live_directories)
+        if segment_infos['generation'] != self.segment_generation:
+            self.result_cache.clear()
+        self.segment_generation = segment_infos['generation']
+        self.segment_infos_file_id = None if segment_infos_stat is None \
+            else (segment_infos_stat.st_ino, segment_infos_stat.st_mtime_ns)
+        self.doc_id_bases = numpy.zeros(len(segments) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(segment) for segment in segments],
+                     out=self.doc_id_bases[1:])
+        self.collection_term_count = sum(
+            segment.collection_term_count for segment in segments)
+
+    # switches to a new generation of segments written by
+    # IndexCreator.update_index or a merge, doc ids of different generations
+    # must not be mixed
+    def refresh_index(self):
+        try:
+            segment_infos_stat = os.stat(
+                f'{self.directory}/{segment_infos_file_name}')
+        except FileNotFoundError:
+            return
+        if (segment_infos_stat.st_ino, segment_infos_stat.st_mtime_ns) != \
+                self.segment_infos_file_id:
+            self.load_segments()
+
+    # returns the values of the segment arrays called name for doc_ids
+    def get_segment_values(self, name, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        segment_indices = numpy.searchsorted(
+            self.doc_id_bases, doc_ids, side='right') - 1
+        values = numpy.zeros(len(doc_ids), dtype=numpy.int64)
+        for segment_index in numpy.unique(segment_indices).tolist():
+            is_in_segment = segment_indices == segment_index
+            values[is_in_segment] = getattr(
+                self.segments[segment_index], name)[
+                doc_ids[is_in_segment] - self.doc_id_bases[segment_index]]
+        return values
+
+    # segments: list of (segment index, segment) to search, default all
+    def get_stem_segments(self, stem, segments=None):
+        if segments is None:
+            segments = enumerate(self.segments)
+        return [(segment_index, segment)
+                for segment_index, segment in segments
+                if stem in segment.seek_list]
+
+    def contains_stem(self, stem):
+        return any(stem in segment.seek_list for segment in self.segments)
+
+    def open_posting_list(self, stem, segments=None):
+        return Postings.SegmentedPostingList([
+            (int(self.doc_id_bases[segment_index]),
+             int(self.doc_id_bases[segment_index + 1]),
+             Postings.CachedPostingList(
+                 segment.open_posting_list(stem), self.posting_list_cache,
+                 (segment.directory, stem)),
+             segment.is_deleted)
+            for segment_index, segment in self.get_stem_segments(
+                stem, segments)])
+
+    def load_posting_list(self, stem):
+        return self.open_posting_list(stem).decode()
+
+    # document counts include deleted docs, they are only used to estimate
+    # the cost of posting lists
+    def get_document_count(self, stem):
+        return sum(segment.seek_list[stem][0][2]
+                   for _, segment in self.get_stem_segments(stem))
+
+    # term counts and collection_term_count only count comments which are
+    # not deleted, so deleted comments do not influence scores
+    def get_term_count(self, stem):
+        return sum(segment.get_term_count(stem)
+                   for _, segment in self.get_stem_segments(stem))
+
+    def get_max_term_frequency(self, stem):
+        return max((segment.seek_list[stem][0][4]
+                    for _, segment in self.get_stem_segments(stem)),
+                   default=0)
+
+    def get_comment_term_counts(self, doc_ids):
+        return self.get_segment_values('comment_term_counts', doc_ids)
+
+    def get_comment_offsets(self, doc_ids):
+        return self.get_segment_values('comment_offsets', doc_ids)
+
+    def get_cid_to_doc_id(self, cid):
+        return self.get_doc_ids_for_cids([cid])[0]
+
+    # returns doc ids of all cids contained in the index
+    def get_doc_ids_for_cids(self, cids):
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [
+            doc_id_base + segment.get_doc_ids_for_cids(cids)
+            for doc_id_base, segment in zip(self.doc_id_bases, self.segments)])
+
+    # returns scores based on natural language model with dirichlet smoothing
     # query_terms: list of query terms, stemmed and filtered
-    # comment_offsets: list of offsets of comments into comment file
-    def get_dirichlet_smoothed_score(self, query_terms, comment_offsets,
-                                     mu=1500):
-        ranked_comments = [[0, offset] for offset in comment_offsets]
+    # doc_ids: sorted array of doc ids of comments
+    # returns array of scores in the order of doc_ids
+    def get_dirichlet_smoothed_scores(self, query_terms, doc_ids, mu=1500):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        scores = numpy.zeros(len(doc_ids))
+        comment_term_counts = self.get_comment_term_counts(doc_ids)
         for query_term in query_terms:
             query_stem = self.stemmer.stemWord(query_term)
-            if query_stem not in self.seek_list or \
-                    self.seek_list[query_stem][0][1] > \
-                    self.collection_term_count / 100:
+            if not self.contains_stem(query_stem):
                 continue
-            posting_list_parts = self.load_posting_list_parts(query_stem)
-            query_term_count = int(posting_list_parts[1])
-            comment_offsets_index = 0
-            for comment_list in posting_list_parts[2:]:
-                if comment_offsets_index >= len(comment_offsets):
-                    break
-                first_occurence = int(comment_list.partition(',')[0])
-                len_occurrences = comment_list.count(',') + 1
-                while (comment_offsets_index < len(comment_offsets)
-                        and first_occurence >
-                        comment_offsets[comment_offsets_index]):
-                    # term not found -> 0 occurences in comment
-                    ranked_comments[comment_offsets_index][0] += math.log(
-                        (mu * query_term_count / self.collection_term_count)
-                        / (self.get_comment_term_count(comment_offsets[
-                            comment_offsets_index]) + mu))
-                    comment_offsets_index += 1
-
-                if(comment_offsets_index < len(comment_offsets)
-                        and first_occurence ==
-                        comment_offsets[comment_offsets_index]):
-                    fD_query_term = len_occurrences - 1
-                    ranked_comments[comment_offsets_index][0] += math.log(
-                        (fD_query_term + (mu * query_term_count
-                                          / self.collection_term_count))
-                        / (self.get_comment_term_count(comment_offsets[
-                            comment_offsets_index]) + mu))
-                    comment_offsets_index += 1
-            while comment_offsets_index < len(comment_offsets):
-                # no matches found
-                ranked_comments[comment_offsets_index][0] += math.log(
-                    (mu * query_term_count / self.collection_term_count)
-                    / (self.get_comment_term_count(comment_offsets[
-                        comment_offsets_index]) + mu))
-                comment_offsets_index += 1
-
-        return ranked_comments
-
-    # load comment from given offset into comment file
-    def load_comment(self, offset):
-        self.comment_file.seek(offset)
-        comment_as_list = next(self.comment_csv_reader)
-        comment = Comment()
-        comment.cid = int(comment_as_list[0])
-        # comment.article_url = self.articles_list[int(comment_as_list[1])]
-        # comment.author = self.authors_list[int(comment_as_list[2])]
-        comment.text = comment_as_list[3]
-        # comment.timestamp = comment_as_list[4]
-        # comment.parent_cid = int(comment_as_list[5]) \
-        #    if comment_as_list[5] != '' else -1
-        comment.upvotes = int(comment_as_list[6]) \
-            if len(comment_as_list) >= 7 else 0
-        comment.downvotes = int(comment_as_list[7]) \
-            if len(comment_as_list) >= 8 else 0
-
-        return comment
+            # stems only in deleted comments are treated as absent
+            query_term_count = self.get_term_count(query_stem)
+            if query_term_count == 0 or \
+                    query_term_count > self.collection_term_count / 100:
+                continue
+            posting_list = self.load_posting_list(query_stem)
+            term_frequencies = posting_list.term_frequencies_of(doc_ids)
+            scores += numpy.log(
+                (term_frequencies + (mu * query_term_count
+                                     / self.collection_term_count))
+                / (comment_term_counts + mu))
+
+        return scores
+
+    # returns the top_k doc ids of comments containing any of the query_terms
+    # and their scores in descending order, scores are the same as the ones of
+    # get_dirichlet_smoothed_scores
+    # comments are only scored completely if they can still enter the top_k
+    # (block-max MaxScore), for this the score of a comment is split into
+    # sum(log(mu * p_stem)) over all stems
+    # + sum(log(1 + term_frequency / (mu * p_stem))) over contained stems
+    # - len(query_terms) * log(comment_term_count + mu)
+    # where the second part is bounded by the maximum term frequency of a stem
+    # in the whole posting list or a block and the third part by 0
+    def get_top_k_dirichlet_smoothed_scores(self, query_terms, top_k,
+                                            mu=1500):
+        stem_weights = {}
+        for query_term in query_terms:
+            query_stem = self.stemmer.stemWord(query_term)
+            # stems only in deleted comments are treated as absent
+            if self.contains_stem(query_stem) and \
+                    self.get_term_count(query_stem) > 0:
+                stem_weights[query_stem] = stem_weights.get(query_stem, 0) + 1
+        posting_lists = {stem: self.open_posting_list(stem)
+                         for stem in stem_weights.keys()}
+        # stems too frequent to be scored only contribute candidates
+        for stem in list(stem_weights.keys()):
+            if self.get_term_count(stem) > self.collection_term_count / 100:
+                stem_weights[stem] = 0
+        smoothing = {stem: mu * self.get_term_count(stem)
+                     / self.collection_term_count
+                     for stem in stem_weights.keys()}
+        constant_score = sum(weight * math.log(smoothing[stem])
+                             for stem, weight in stem_weights.items())
+        query_length = sum(stem_weights.values())
+
+        def term_scores(stem, term_frequencies):
+            return stem_weights[stem] * numpy.log1p(
+                term_frequencies / smoothing[stem])
+
+        def length_scores(doc_ids):
+            return constant_score - query_length * numpy.log(
+                self.get_comment_term_counts(doc_ids) + mu)
+
+        # the comments of the rarest scored stem give a first threshold
+        scored_stems = [stem for stem, weight in stem_weights.items()
+                        if weight > 0]
+        doc_ids = numpy.zeros(0, dtype=numpy.int64)
+        scores = numpy.zeros(0)
+        threshold = -math.inf
+        if len(scored_stems) > 0:
+            rarest_stem = min(scored_stems, key=lambda stem: len(
+                posting_lists[stem]))
+            doc_ids = posting_lists[rarest_stem].doc_ids()
+            scores = length_scores(doc_ids)
+            for stem in scored_stems:
+                scores += term_scores(
+                    stem, posting_lists[stem].term_frequencies_of(doc_ids))
+            if len(scores) >= top_k:
+                threshold = numpy.partition(scores, -top_k)[-top_k]
+
+        # comments containing only non essential stems cannot reach the
+        # threshold, so only comments of essential stems are candidates
+        upper_bounds = {stem: float(term_scores(
+            stem, self.get_max_term_frequency(stem)))
+            for stem in stem_weights.keys()}
+        non_essential_stems = []
+        upper_bound = constant_score - query_length * math.log(mu)
+        for stem in sorted(stem_weights.keys(), key=upper_bounds.get):
+            if upper_bound + upper_bounds[stem] >= threshold:
+                break
+            upper_bound += upper_bounds[stem]
+            non_essential_stems.append(stem)
+        essential_posting_lists = {
+            stem: posting_lists[stem].decode()
+            for stem in stem_weights.keys() if stem not in non_essential_stems}
+        if len(essential_posting_lists) == 0:
+            return doc_ids[:0], scores[:0]
+        candidates = numpy.setdiff1d(numpy.unique(numpy.concatenate([
+            posting_list.doc_ids
+            for posting_list in essential_posting_lists.values()])),
+            doc_ids, assume_unique=True)
+
+        candidate_scores = length_scores(candidates)
+        for stem, posting_list in essential_posting_lists.items():
+            candidate_scores += term_scores(
+                stem, posting_list.term_frequencies_of(candidates))
+        candidate_upper_bounds = candidate_scores.copy()
+        for stem in non_essential_stems:
+            candidate_upper_bounds += term_scores(
+                stem, posting_lists[stem].block_max_term_frequencies_of(
+                    candidates))
+        # leave some room for rounding errors
+        is_candidate = candidate_upper_bounds >= threshold - 1e-9
+        candidates = candidates[is_candidate]
+        candidate_scores = candidate_scores[is_candidate]
+        for stem in non_essential_stems:
+            candidate_scores += term_scores(
+                stem, posting_lists[stem].term_frequencies_of(candidates))
+
+        doc_ids = numpy.concatenate((doc_ids, candidates))
+        scores = numpy.concatenate((scores, candidate_scores))
+        result = rank_scores(doc_ids, scores, top_k)
+        return doc_ids[result], scores[result]
+
+    # returns the comments of doc_ids in the same order, they are read from
+    # the stored fields of the segments, so comments.csv is not needed
+    def load_comments(self, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        segment_indices = numpy.searchsorted(
+            self.doc_id_bases, doc_ids, side='right') - 1
+        records = [None] * len(doc_ids)
+        for segment_index in numpy.unique(segment_indices).tolist():
+            indices = numpy.flatnonzero(segment_indices == segment_index)
+            for index, record in zip(indices.tolist(), self.segments[
+                    segment_index].stored_fields.get_records(
+                    doc_ids[indices] - self.doc_id_bases[segment_index])):
+                records[index] = record
+        return [Comment(cid=cid, article_url=self.articles_list[article_id],
+                        author=self.authors_list[author_id], text=text,
+                        timestamp=timestamp, parent_cid=parent_cid,
+                        upvotes=upvotes, downvotes=downvotes)
+                for cid, article_id, author_id, text, timestamp, parent_cid,
+                upvotes, downvotes in records]
 
     def load_comment_from_cid(self, cid):
-        return self.load_comment(self.get_cid_to_offset(cid))
-
-    def load_cid_only(self, offset):
-        self.comment_file.seek(offset)
-        csv_line_start = self.comment_file.read(8)
-        comma_position = csv_line_start.find(b',')
-        while comma_position == -1:
-            csv_line_start += self.comment_file.read(8)
-            comma_position = csv_line_start.find(b',')
-        return csv_line_start[:comma_position].decode()
-
-    # returns offsets into comment file for all comments containing stem in
-    # ascending order
-    def get_offsets_for_stem(self, stem):
-        if stem not in self.seek_list:
-            return []
-        posting_list_parts = self.load_posting_list_parts(stem)
-        return [int(x.partition(',')[0]) for x in posting_list_parts[2:]]
-
-    def phrase_query(self, phrase, suffix=''):
+        return self.load_comments([self.get_cid_to_doc_id(cid)])[0]
+
+    def get_comment_cids(self, doc_ids):
+        return self.get_segment_values('comment_cids', doc_ids)
+
+    # returns doc ids of all comments containing stem in ascending order
+    # the whole posting list is decoded, ranked queries score the same stems
+    # right afterwards and find them in the posting list cache
+    def get_doc_ids_for_stem(self, stem):
+        if not self.contains_stem(stem):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return self.load_posting_list(stem).doc_ids
+
+    # returns the stems of text with their token positions like they are
+    # indexed, stems which are not indexed are left out, and the number of
+    # tokens
+    def get_positioned_stems(self, text):
+        stems = []
+        for sentence in nltk.tokenize.sent_tokenize(text.lower()):
+            stems.extend(self.stemmer.stemWords(
+                self.tokenizer.tokenize(sentence)))
+        return ([(position, stem) for position, stem in enumerate(stems)
+                 if 1 < len(stem) <= 128], len(stems))
+
+    # returns sorted doc ids of comments with an occurrence of every stem
+    # group at its offset relative to a common start position
+    # stem_groups: list of (offset, stems), occurrences of any of the stems
+    # of a group match
+    # candidates: sorted array of the only doc ids to check or None for all,
+    # the same for all other queries
+    def positional_query(self, stem_groups, candidates=None):
+        doc_ids = numpy.zeros(0, dtype=numpy.int64)
+        group_posting_lists = []
+        for offset, stems in stem_groups:
+            posting_lists = [self.open_posting_list(stem) for stem in stems
+                             if self.contains_stem(stem)]
+            if len(posting_lists) == 0:
+                return doc_ids
+            group_posting_lists.append((offset, posting_lists))
+        if len(group_posting_lists) == 0:
+            return doc_ids
+
+        # candidates contain all groups, intersecting starts with the rarest
+        group_posting_lists.sort(key=lambda group: sum(
+            len(posting_list) for posting_list in group[1]))
+        doc_ids = numpy.unique(numpy.concatenate([
+            restricted_doc_ids(posting_list, candidates)
+            for posting_list in group_posting_lists[0][1]]))
+        for _, posting_lists in group_posting_lists[1:]:
+            if len(doc_ids) == 0:
+                return doc_ids
+            doc_ids = numpy.unique(numpy.concatenate([
+                posting_list.intersect(doc_ids)
+                for posting_list in posting_lists]))
+
+        # the position keys of all groups are equal at the start position of
+        # a match, positions are only decoded for the candidates
+        match_keys = None
+        for offset, posting_lists in group_posting_lists:
+            keys = numpy.unique(numpy.concatenate([
+                posting_list.postings_of(doc_ids).position_keys(offset)
+                for posting_list in posting_lists]))
+            match_keys = keys if match_keys is None else numpy.intersect1d(
+                match_keys, keys, assume_unique=True)
+        return numpy.unique(match_keys >> 32)
+
+    # phrases are matched by the positions of their stems, so a phrase
+    # matches all comments containing the same stems in the same order,
+    # tokens which are not indexed match any token
+    # suffix: prefix of the token following the phrase
+    def phrase_query(self, phrase, suffix='', candidates=None):
         if phrase == '' and suffix != '':
             # suffix of the phrase now becomes prefix for a prefix query
-            return self.prefix_query(suffix)
-
-        if ' ' not in phrase:
-            offsets = self.keyword_query(phrase)
-        else:
-            stem_offset_size_list = []  # may contain duplicates!
-            for sentence in nltk.tokenize.sent_tokenize(phrase):
-                for token in self.tokenizer.tokenize(sentence):
-                    stem = self.stemmer.stemWord(token)
-                    if stem not in self.seek_list:
-                        continue
-                    stem_offset_size_list.append((stem, self.seek_list[stem]))
-
-            if len(stem_offset_size_list) == 0:
-                return []
-
-            # sort by posting_list size
-            stem_offset_size_list.sort(key=lambda t: t[1][0][1])
-            smallest_stem = stem_offset_size_list[0][0]
-            second_smallest_stem = stem_offset_size_list[1][0] \
-                if len(stem_offset_size_list) >= 2 and \
-                stem_offset_size_list[1][1][0][1] < \
-                self.collection_term_count / 100 else ''
-            offsets = self.get_offsets_for_stem(smallest_stem)
-            if second_smallest_stem != '':
-                offsets = set(offsets)
-                offsets.intersection_update(
-                    self.get_offsets_for_stem(second_smallest_stem))
-
-        result = []
-        phrase_to_check = phrase if suffix == '' else f'{phrase} {suffix}'
-        for offset in offsets:
-            comment = self.load_comment(offset)
-            if phrase_to_check in comment.text.lower():
-                result.append(offset)
-        return result
-
-    def prefix_query(self, prefix):
-        stems_with_prefix = self.seek_list.keys(prefix)
-        result = []
-        for stem in stems_with_prefix:
-            result.extend(self.get_offsets_for_stem(stem))
-        return result
-
-    def keyword_query(self, keyword):
-        return self.get_offsets_for_stem(
-            self.stemmer.stemWord(keyword))
+            return self.prefix_query(suffix, candidates)
+
+        positioned_stems, token_count = self.get_positioned_stems(phrase)
+        stem_groups = [(position, [stem])
+                       for position, stem in positioned_stems]
+        if suffix != '':
+            stem_groups.append(
+                (token_count, self.get_stems_with_prefix(suffix)))
+        return self.positional_query(stem_groups, candidates)
+
+    # returns the max_prefix_stems ones of the sorted stems contained in the
+    # most comments if there are more
+    # segments: list of (segment index, segment) to search
+    def limit_expanded_stems(self, stems, segments):
+        if len(stems) <= self.max_prefix_stems:
+            return stems
+        document_counts = {stem: sum(
+            segment.seek_list[stem][0][2]
+            for _, segment in self.get_stem_segments(stem, segments))
+            for stem in stems}
+        return sorted(sorted(stems, key=document_counts.get, reverse=True)[
+            :self.max_prefix_stems])
+
+    # returns the stems starting with prefix, at most max_prefix_stems
+    # segments: list of (segment index, segment) to search, default all
+    def get_stems_with_prefix(self, prefix, segments=None):
+        if segments is None:
+            segments = list(enumerate(self.segments))
+        return self.limit_expanded_stems(sorted(set().union(*(
+            segment.seek_list.keys(prefix) for _, segment in segments))),
+            segments)
+
+    # returns sorted doc ids of the comments containing any of the stems in
+    # segments, a list of (segment index, segment)
+    def get_doc_ids_for_stems(self, stems, segments, candidates=None):
+        return numpy.unique(numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.int64)] + [
+                restricted_doc_ids(
+                    self.open_posting_list(stem, segments), candidates)
+                for stem in stems]))
+
+    # segments with precomputed doc ids of the prefix are not expanded, their
+    # results contain the comments of all stems with the prefix, so they are
+    # only used if the prefix has at most max_prefix_stems stems in the whole
+    # index, otherwise the results would depend on the segmentation
+    def prefix_query(self, prefix, candidates=None):
+        segments = list(enumerate(self.segments))
+        stems = sorted(set().union(*(
+            segment.seek_list.keys(prefix) for segment in self.segments)))
+        if len(stems) > self.max_prefix_stems:
+            return self.get_doc_ids_for_stems(
+                self.limit_expanded_stems(stems, segments), segments,
+                candidates)
+        doc_id_arrays = [numpy.zeros(0, dtype=numpy.int64)]
+        expanded_segments = []
+        for segment_index, segment in segments:
+            doc_ids = segment.get_prefix_doc_ids(prefix)
+            if doc_ids is None:
+                expanded_segments.append((segment_index, segment))
+            else:
+                doc_ids = self.doc_id_bases[segment_index] + doc_ids
+                doc_id_arrays.append(
+                    doc_ids if candidates is None
+                    else intersect_sorted(doc_ids, candidates))
+        if len(expanded_segments) > 0:
+            doc_id_arrays.append(self.get_doc_ids_for_stems(
+                stems, expanded_segments, candidates))
+        return numpy.unique(numpy.concatenate(doc_id_arrays))
+
+    # pattern: word pattern in which * stands for any number of characters,
+    # expanded to the stems of the matching words, at most max_prefix_stems
+    # like prefixes
+    def wildcard_query(self, pattern, candidates=None):
+        segments = list(enumerate(self.segments))
+        stems = sorted(set().union(*(
+            segment.kgram_index.get_matching_stems(pattern)
+            for segment in self.segments)))
+        return self.get_doc_ids_for_stems(
+            self.limit_expanded_stems(stems, segments), segments, candidates)
+
+    # returns the sorted position keys of the stem in the sorted array doc_ids
+    def get_position_keys(self, stem, doc_ids):
+        return self.open_posting_list(stem).postings_of(
+            doc_ids).position_keys()
+
+    # returns sorted doc ids of comments in which the stems of both keywords
+    # occur at most distance tokens apart, positions are only decoded for
+    # comments containing both stems
+    def near_query(self, keywords, distance, candidates=None):
+        stems = self.stemmer.stemWords(keywords)
+        if not all(self.contains_stem(stem) for stem in stems):
+            return numpy.zeros(0, dtype=numpy.int64)
+        posting_lists = sorted(
+            (self.open_posting_list(stem) for stem in stems), key=len)
+        doc_ids = posting_lists[1].intersect(
+            restricted_doc_ids(posting_lists[0], candidates))
+        keys = self.get_position_keys(stems[0], doc_ids)
+        return numpy.unique(keys[Postings.is_near(
+            keys, self.get_position_keys(stems[1], doc_ids), distance)]
+            >> 32)
+
+    # returns the number of pairs of consecutive query stems which occur at
+    # most proximity_window tokens apart in each comment of the sorted array
+    # doc_ids
+    def get_proximity_counts(self, query_terms, doc_ids):
+        stems = [stem for stem in self.stemmer.stemWords(query_terms)
+                 if self.contains_stem(stem)]
+        proximity_counts = numpy.zeros(len(doc_ids), dtype=numpy.int64)
+        for stem, next_stem in zip(stems, stems[1:]):
+            if stem == next_stem:
+                continue
+            keys = self.get_position_keys(stem, doc_ids)
+            near_doc_ids = numpy.unique(keys[Postings.is_near(
+                keys, self.get_position_keys(next_stem, doc_ids),
+                self.proximity_window)] >> 32)
+            proximity_counts += numpy.isin(
+                doc_ids, near_doc_ids, assume_unique=True)
+        return proximity_counts
+
+    def keyword_query(self, keyword, candidates=None):
+        stem = self.stemmer.stemWord(keyword)
+        if candidates is None or not self.contains_stem(stem):
+            return self.get_doc_ids_for_stem(stem)
+        # the skip table of the posting list is used to find the candidates
+        return self.open_posting_list(stem).intersect(candidates)
+
+    # returns cids of all replies to any of the parent_cids
+    def get_reply_cids(self, parent_cids):
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [
+            segment.get_reply_cids(parent_cids) for segment in self.segments])
 
     def reply_to_query(self, target_cid):
-        return [self.cid_to_offset[cid]
-                for cid in self.reply_to_index.get(target_cid, ())]
-
-    def basic_search(self, token_node):
-        # search for a single query token
+        return numpy.unique(self.get_doc_ids_for_cids(
+            self.get_reply_cids([target_cid])))
+
+    # returns cids of all direct and indirect replies to target_cid,
+    # the reply graph is traversed breadth first one level at a time
+    def get_descendant_cids(self, target_cid):
+        visited_cids = numpy.array([target_cid], dtype=numpy.int64)
+        descendant_cids = []
+        current_cids = visited_cids
+        while len(current_cids) > 0:
+            current_cids = numpy.setdiff1d(
+                self.get_reply_cids(current_cids), visited_cids)
+            visited_cids = numpy.union1d(visited_cids, current_cids)
+            descendant_cids.append(current_cids)
+        return numpy.concatenate(descendant_cids)
+
+    # returns the cid of the first comment of the conversation containing cid,
+    # which may not be contained in the index itself
+    def get_thread_root_cid(self, cid):
+        visited_cids = set()
+        while cid not in visited_cids:
+            visited_cids.add(cid)
+            parent_cids = self.get_segment_values(
+                'comment_parent_cids', self.get_doc_ids_for_cids([cid])[:1])
+            if len(parent_cids) == 0 or parent_cids[0] == -1:
+                break
+            cid = int(parent_cids[0])
+        return cid
+
+    def descendants_of_query(self, target_cid):
+        return numpy.unique(self.get_doc_ids_for_cids(
+            self.get_descendant_cids(target_cid)))
+
+    def thread_of_query(self, target_cid):
+        root_cid = self.get_thread_root_cid(target_cid)
+        return numpy.unique(self.get_doc_ids_for_cids(numpy.append(
+            self.get_descendant_cids(root_cid), root_cid)))
+
+    def basic_search(self, token_node, candidates=None):
+        # search for a single query token, returns a sorted array of the doc
+        # ids of all matching comments, only of the candidates if they are
+        # not None
 
         if token_node.kind == 'phrase_prefix':  # phrase prefix query: 'hi ye'*
             return self.phrase_query(
-                token_node.phrase_start, token_node.prefix)
+                token_node.phrase_start, token_node.prefix, candidates)
         elif token_node.kind == 'phrase':  # phrase query: 'european union'
-            return self.phrase_query(token_node.phrase)
+            return self.phrase_query(token_node.phrase, '', candidates)
         elif token_node.kind == 'prefix':  # prefix query: isra*
-            return self.prefix_query(token_node.prefix)
-        elif token_node.kind == 'reply_to':  # ReplyTo query: ReplyTo:12345
-            return self.reply_to_query(token_node.target_cid)
+            return self.prefix_query(token_node.prefix, candidates)
+        elif token_node.kind == 'wildcard':  # wildcard query: euro*zone
+            return self.wildcard_query(token_node.pattern, candidates)
         elif token_node.kind == 'keyword':  # keyword query: merkel
-            return self.keyword_query(token_node.keyword)
+            return self.keyword_query(token_node.keyword, candidates)
+        elif token_node.kind == 'near':  # proximity query: trump NEAR/5 putin
+            return self.near_query(
+                token_node.keywords, token_node.distance, candidates)
+
+        if token_node.kind == 'reply_to':  # ReplyTo query: ReplyTo:12345
+            doc_ids = self.reply_to_query(token_node.target_cid)
+        elif token_node.kind == 'thread_of':  # ThreadOf query: ThreadOf:12345
+            doc_ids = self.thread_of_query(token_node.target_cid)
+        elif token_node.kind == 'descendants_of':
+            # DescendantsOf query: DescendantsOf:12345
+            doc_ids = self.descendants_of_query(token_node.target_cid)
         else:
             raise RuntimeError(f'unknown token_node.kind: {token_node.kind}')
+        return doc_ids if candidates is None \
+            else intersect_sorted(doc_ids, candidates)
+
+    # returns an estimate of the number of comments matching token_node from
+    # the document counts of the seek lists without evaluating it, 0 only if
+    # it cannot match anything
+    # for AND nodes the one of their rarest child, for OR and space nodes the
+    # sum of their children, negation is ignored
+    def estimate_document_count(self, token_node):
+        if isinstance(token_node, AndNode):
+            return min(self.estimate_document_count(child)
+                       for child in token_node.children
+                       if not child.is_negated)
+        elif isinstance(token_node, (OrNode, SpaceNode)):
+            return min(int(self.doc_id_bases[-1]), sum(
+                self.estimate_document_count(child)
+                for child in token_node.children))
+        elif token_node.kind == 'keyword':
+            return self.get_document_count(
+                self.stemmer.stemWord(token_node.keyword))
+        elif token_node.kind in ('phrase', 'phrase_prefix'):
+            # a phrase matches at most the comments of its rarest stem
+            positioned_stems, _ = self.get_positioned_stems(
+                token_node.phrase if token_node.kind == 'phrase'
+                else token_node.phrase_start)
+            document_counts = [self.get_document_count(stem)
+                               for _, stem in positioned_stems]
+            if token_node.kind == 'phrase_prefix':
+                document_counts.append(
+                    self.estimate_prefix_document_count(token_node.prefix))
+            return min(document_counts, default=0)
+        elif token_node.kind == 'near':
+            return min(self.get_document_count(stem) for stem
+                       in self.stemmer.stemWords(token_node.keywords))
+        elif token_node.kind == 'prefix':
+            return self.estimate_prefix_document_count(token_node.prefix)
+        elif token_node.kind == 'wildcard':
+            # stems are only matched when the query is evaluated
+            return int(self.doc_id_bases[-1])
+        elif token_node.kind in ('reply_to', 'descendants_of'):
+            # looking up direct replies is cheap, they usually dominate
+            return len(self.get_reply_cids([token_node.target_cid]))
+        elif token_node.kind == 'thread_of':
+            return 1 + len(self.get_reply_cids([token_node.target_cid]))
+        else:
+            raise RuntimeError(f'unknown token_node.kind: {token_node.kind}')
+
+    # sum of the document counts of all stems with prefix
+    def estimate_prefix_document_count(self, prefix):
+        document_count = 0
+        for segment in self.segments:
+            if prefix in segment.prefix_seek_list:
+                document_count += segment.prefix_seek_list[prefix][0][1]
+            else:
+                document_count += sum(
+                    segment.seek_list[stem][0][2]
+                    for stem in segment.seek_list.keys(prefix))
+        return document_count
+
+    # returns the children of the and_node in the order of their evaluation:
+    # children which are not negated rarest first, then negated ones which
+    # only remove comments from the result, an empty list if a child cannot
+    # match anything
+    def plan_and_node(self, and_node):
+        estimated_children = sorted(
+            (child.is_negated, self.estimate_document_count(child), index)
+            for index, child in enumerate(and_node.children))
+        if estimated_children[0][1] == 0:
+            return []
+        return [and_node.children[index]
+                for _, estimate, index in estimated_children if estimate > 0]
+
+    # returns the PlanNode of the query tree below query_node, see
+    # QueryTree.PlanNode
+    # shared_keys: keys of subtrees occurring more than once in the query
+    def compile_query_node(self, query_node, shared_keys):
+        key = query_node.key(self.stemmer.stemWord)
+        if isinstance(query_node, TokenNode):
+            return PlanNode(query_node, key, [], False)
+        children = self.plan_and_node(query_node) \
+            if isinstance(query_node, AndNode) else query_node.children
+        return PlanNode(query_node, key, [
+            self.compile_query_node(child, shared_keys) for child in children],
+            key in shared_keys)
+
+    # returns the evaluation plan of the query tree, it is valid until the
+    # index changes
+    # repeated AND, OR and space subtrees like (a OR b) in
+    # ((a OR b) AND c) OR ((a OR b) AND d) are evaluated only once, posting
+    # lists of repeated tokens are already cached
+    def compile_query(self, query_tree_root):
+        key_counts = {}
+        nodes = list(query_tree_root.children)
+        while len(nodes) > 0:
+            node = nodes.pop()
+            if not isinstance(node, TokenNode):
+                key = node.key(self.stemmer.stemWord)
+                key_counts[key] = key_counts.get(key, 0) + 1
+                nodes.extend(node.children)
+        return self.compile_query_node(query_tree_root, {
+            key for key, count in key_counts.items() if count > 1})
+
+    # returns a Bitmap of the doc ids of comments matching the query tree of
+    # plan_node, ignoring its negation, only of the sorted array candidates if
+    # it is not None
+    # every child of an AND node is only evaluated on the comments matching
+    # all children before it, so expensive ones like phrases are only
+    # verified on the survivors of selective ones and negated ones only need
+    # to look up the remaining comments, which are then removed from the
+    # bitmap of the survivors
+    def execute_plan(self, plan_node, candidates=None):
+        if plan_node.is_shared:
+            # results of shared subtrees are computed once for all candidates
+            # and cached as compressed bitmaps
+            subtree_key = ('subtree', plan_node.key)
+            result = self.result_cache.get(subtree_key)
+            if result is None:
+                result = self.execute_plan(PlanNode(
+                    plan_node.query_node, plan_node.key, plan_node.children,
+                    False)).optimize()
+                self.result_cache.put(
+                    subtree_key, result,
+                    result.nbytes + result_cache_entry_overhead)
+            return result if candidates is None \
+                else result & Bitmap.from_sorted(candidates)
+
+        if isinstance(plan_node.query_node, TokenNode):
+            return Bitmap.from_sorted(
+                self.basic_search(plan_node.query_node, candidates))
+        if isinstance(plan_node.query_node, AndNode):
+            if len(plan_node.children) == 0:  # a child cannot match anything
+                return Bitmap()
+            and_result = None
+            for child in plan_node.children:
+                child_result = self.execute_plan(child, candidates)
+                if child.is_negated:
+                    and_result = and_result - child_result
+                else:
+                    and_result = child_result
+                if len(and_result) == 0:
+                    break
+                candidates = and_result.to_array()
+            return and_result
+        # OR and space nodes
+        result = Bitmap()
+        for child in plan_node.children:
+            result = result | self.execute_plan(child, candidates)
+        return result
 
-    def print_comments(self, offset_iterable, printIdsOnly=True):
+    def print_comments(self, doc_id_iterable, printIdsOnly=True):
+        doc_ids = list(doc_id_iterable)
         if printIdsOnly:
-            print(','.join((self.load_cid_only(offset)
-                            for offset in offset_iterable)))
+            print(','.join(map(str, self.get_comment_cids(doc_ids).tolist())))
         else:
-            for offset in offset_iterable:
-                comment = self.load_comment(offset)
+            for comment in self.load_comments(doc_ids):
                 print(f'{comment.cid},{comment.text}')
 
-    def search(self, query, top_k=None, printIdsOnly=True):
-        print(f'\nsearching for "{query}":')
-
+    # returns the doc ids of the results of query, the ones of non boolean
+    # queries in order of their scores
+    # results are cached by the key of the query tree and top_k until the
+    # index changes, the key ignores the order of children and repetitions
+    # within AND and OR, but not the multiset of query terms of ranked
+    # queries, since repeated terms change the scores
+    # proximity_boost: rank comments with query terms close to each other
+    # higher, see __init__
+    def evaluate(self, query, top_k=None, proximity_boost=False):
         query_tree_root = build_query_tree(query)
         if query_tree_root.is_boolean_query:
-            or_result = set()
+            top_k = None  # boolean results are not ranked nor cut
+            proximity_boost = False
+        # proximity boosting also depends on the order of the query terms,
+        # which the key of the query tree ignores
+        result_key = (query_tree_root.key(self.stemmer.stemWord), top_k,
+                      tuple(self.stemmer.stemWords(
+                          query_tree_root.query_terms))
+                      if proximity_boost else False)
+        doc_ids = self.result_cache.get(result_key)
+        if doc_ids is not None:
+            return doc_ids
+
+        if query_tree_root.is_boolean_query:
             with self.report.measure('searching'):
-                for and_node in query_tree_root.children:
-                    and_result = None
-                    to_be_removed = []
-                    for child in and_node.children:
-                        child_result = self.basic_search(child)
-                        if child.is_negated:
-                            to_be_removed.append(child_result)
-                        elif and_result is None:
-                            and_result = set(child_result)
-                        else:
-                            and_result.intersection_update(child_result)
-                    and_result.difference_update(*to_be_removed)
-                    or_result.update(and_result)
-
-            self.print_comments(or_result, printIdsOnly)
+                doc_ids = self.execute_plan(
+                    self.compile_query(query_tree_root)).to_array()
+        elif top_k is not None and not proximity_boost and all(
+                isinstance(child, TokenNode) and child.kind == 'keyword'
+                for child in query_tree_root.children):
+            with self.report.measure('searching and calculating scores'):
+                doc_ids, scores = self.get_top_k_dirichlet_smoothed_scores(
+                    query_tree_root.query_terms, top_k)
         else:  # non bool query
             with self.report.measure('searching'):
-                children_results = (self.basic_search(child)
-                                    for child in query_tree_root.children)
-                comment_offsets = list(frozenset().union(*children_results))
+                doc_ids = self.execute_plan(
+                    self.compile_query(query_tree_root)).to_array()
 
             with self.report.measure('calculating scores'):
-                # rated_comment is a tuple of (score, offset)
-                rated_comments = self.get_dirichlet_smoothed_score(
-                    query_tree_root.query_terms, comment_offsets)
-                if top_k is not None and len(rated_comments) > top_k:
-                    top_k_rated_comments = \
-                        rated_comments[:top_k]
-                    heapq.heapify(top_k_rated_comments)
-                    for rated_comment in rated_comments[top_k:]:
-                        heapq.heappushpop(top_k_rated_comments, rated_comment)
-                    result = top_k_rated_comments
-                else:
-                    result = rated_comments
-
-                result.sort(key=lambda x: x[0], reverse=True)
-
-            self.print_comments(
-                (offset for score, offset in result), printIdsOnly)
+                scores = self.get_dirichlet_smoothed_scores(
+                    query_tree_root.query_terms, doc_ids)
+                if proximity_boost:
+                    scores += self.proximity_weight * \
+                        self.get_proximity_counts(
+                            query_tree_root.query_terms, doc_ids)
+                doc_ids = doc_ids[rank_scores(doc_ids, scores, top_k)]
+
+        # cached results are shared and therefore read only
+        doc_ids.flags.writeable = False
+        self.result_cache.put(
+            result_key, doc_ids, doc_ids.nbytes + result_cache_entry_overhead)
+        return doc_ids
+
+    def search(self, query, top_k=None, printIdsOnly=True,
+               proximity_boost=False):
+        print(f'\nsearching for "{query}":')
+        self.refresh_index()
+        doc_ids = self.evaluate(query, top_k, proximity_boost)
+        self.print_comments(doc_ids.tolist(), printIdsOnly)
+        return doc_ids
 
 
 if __name__ == '__main__':
@@ -301,6 +853,11 @@ if __name__ == '__main__':
         index_creator = IndexCreator(data_directory)
         index_creator.create_index()
         index_creator.report.all_time_measures()
+    elif argv[1] == 'Update:comments.csv':
+        # indexes comments appended to comments.csv since the last update
+        index_creator = IndexCreator(data_directory)
+        index_creator.update_index()
+        index_creator.report.all_time_measures()
     else:
         search_engine = SearchEngine()
         search_engine.load_index(data_directory)
@@ -309,5 +866,12 @@ if __name__ == '__main__':
         from IRWS_Argument_Parsing import args
 
         for query in open(args.query):
-            search_engine.search(query.strip(), args.topN, args.printIdsOnly)
+            try:
+                search_engine.search(query.strip(), args.topN,
+                                     args.printIdsOnly, args.proximityBoost)
+            except RuntimeError as error:  # unparsable query
+                print(f'invalid query "{query.strip()}": {error}')
             print('\n\n')
+        print('posting list cache:',
+              search_engine.posting_list_cache.statistics())
+        print('result cache:', search_engine.result_cache.statistics())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+import numpy
+from dawg import RecordDAWG
+
+import Postings
+import KGramIndex
+import StoredFields
+from Common import *
+
+# the index consists of segments, each one covering a consecutive range of
+# comments.csv with its own posting lists, seek list and doc id arrays
+# segments.json lists the live segments in order of their comments:
+# {'generation': number of changes to the list,
+#  'next_segment_number': number of the next segment directory,
+#  'segments': [{'name', 'start_offset', 'end_offset', 'document_count',
+#                'deleted_docs': file name of the deleted docs or None,
+#                'deleted_count'}]}
+segment_infos_file_name = 'segments.json'
+# cids of deleted comments and the end of comments.csv at the time of their
+# deletion, older lines of these cids are never indexed again
+deleted_comments_file_name = 'deleted_comments.npy'
+
+
+def load_segment_infos(directory):
+    try:
+        with open(f'{directory}/{segment_infos_file_name}') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'generation': 0, 'next_segment_number': 0, 'segments': []}
+
+
+# the file is replaced atomically, so readers see either the old or the new
+# list of segments
+def save_segment_infos(directory, segment_infos):
+    temp_file_path = f'{directory}/{segment_infos_file_name}.tmp'
+    with open(temp_file_path, mode='w') as f:
+        json.dump(segment_infos, f, indent=1)
+    os.replace(temp_file_path, f'{directory}/{segment_infos_file_name}')
+
+
+# deleted docs of a segment are a bitmap over its doc ids, segment files are
+# never changed, so every change of the deleted docs gets a new file
+def save_deleted_docs(file_path, is_deleted):
+    numpy.save(file_path, numpy.packbits(is_deleted))
+
+
+# returns a boolean array marking the deleted doc ids
+def load_deleted_docs(segment_directory, segment_info):
+    if segment_info.get('deleted_docs') is None:
+        return numpy.zeros(segment_info['document_count'], dtype=bool)
+    return numpy.unpackbits(
+        numpy.load(f'{segment_directory}/{segment_info["deleted_docs"]}'),
+        count=segment_info['document_count']).astype(bool)
+
+
+# doc ids within a segment start at 0 in order of the comment offsets,
+# all files except the seek list are memory mapped
+# deleted docs stay in the posting lists until the segment is merged,
+# they are only removed from the results
+class Segment():
+    def __init__(self, directory, deleted_docs_file_name=None):
+        self.directory = directory
+        self.deleted_docs_file_name = deleted_docs_file_name
+        self.seek_list = RecordDAWG(Postings.seek_list_format)
+        self.seek_list.load(f'{directory}/binary_seek_list.dawg')
+        self.index_data = memory_map(f'{directory}/binary_index')
+        self.prefix_seek_list = RecordDAWG(Postings.prefix_seek_list_format)
+        self.prefix_seek_list.load(f'{directory}/prefix_seek_list.dawg')
+        self.prefix_doc_ids = numpy.load(
+            f'{directory}/prefix_doc_ids.npy', mmap_mode='r')
+        self.kgram_index = KGramIndex.KGramIndex(directory)
+        self.stored_fields = StoredFields.StoredFields(directory)
+        self.comment_offsets = numpy.load(
+            f'{directory}/comment_offsets.npy', mmap_mode='r')
+        self.comment_term_counts = numpy.load(
+            f'{directory}/comment_term_counts.npy', mmap_mode='r')
+        self.collection_term_count = int(numpy.load(
+            f'{directory}/collection_term_count.npy'))
+        self.reply_to_parent_cids = numpy.load(
+            f'{directory}/reply_to_parent_cids.npy', mmap_mode='r')
+        self.reply_to_offsets = numpy.load(
+            f'{directory}/reply_to_offsets.npy', mmap_mode='r')
+        self.reply_to_cids = numpy.load(
+            f'{directory}/reply_to_cids.npy', mmap_mode='r')
+        self.reply_to_doc_ids = numpy.load(
+            f'{directory}/reply_to_doc_ids.npy', mmap_mode='r')
+        self.comment_parent_cids = numpy.load(
+            f'{directory}/comment_parent_cids.npy', mmap_mode='r')
+        self.comment_cids = numpy.load(
+            f'{directory}/comment_cids.npy', mmap_mode='r')
+        self.cids = numpy.load(f'{directory}/cids.npy', mmap_mode='r')
+        self.cid_doc_ids = numpy.load(
+            f'{directory}/cid_doc_ids.npy', mmap_mode='r')
+        self.is_deleted = None
+        self.deleted_doc_ids = numpy.zeros(0, dtype=numpy.int64)
+        if deleted_docs_file_name is not None:
+            self.is_deleted = load_deleted_docs(directory, {
+                'deleted_docs': deleted_docs_file_name,
+                'document_count': len(self.comment_offsets)})
+            self.deleted_doc_ids = numpy.flatnonzero(self.is_deleted)
+            self.collection_term_count -= int(
+                self.comment_term_counts[self.deleted_doc_ids].sum())
+        self.deleted_term_counts = {}
+
+    def __len__(self):
+        return len(self.comment_offsets)
+
+    def open_posting_list(self, stem):
+        offset, size, document_count, term_count, _ = self.seek_list[stem][0]
+        return Postings.EncodedPostingList(
+            memoryview(self.index_data)[offset:offset + size],
+            document_count, term_count)
+
+    # returns the sorted doc ids of all comments containing a stem starting
+    # with prefix, except deleted ones, or None if the prefix is not
+    # precomputed
+    def get_prefix_doc_ids(self, prefix):
+        if prefix not in self.prefix_seek_list:
+            return None
+        start, count = self.prefix_seek_list[prefix][0]
+        return Postings.remove_deleted(
+            self.prefix_doc_ids[start:start + count], self.is_deleted)
+
+    # term count of the stem in comments which are not deleted
+    def get_term_count(self, stem):
+        term_count = self.seek_list[stem][0][3]
+        if len(self.deleted_doc_ids) == 0:
+            return term_count
+        if stem not in self.deleted_term_counts:
+            self.deleted_term_counts[stem] = int(self.open_posting_list(
+                stem).term_frequencies_of(self.deleted_doc_ids).sum())
+        return term_count - self.deleted_term_counts[stem]
+
+    # returns a boolean array marking the doc ids which are not deleted
+    def get_is_live(self):
+        if self.is_deleted is None:
+            return numpy.ones(len(self), dtype=bool)
+        return ~self.is_deleted
+
+    # returns doc ids of all cids contained in the segment, except deleted ones
+    def get_doc_ids_for_cids(self, cids):
+        indices = find_sorted_all(
+            self.cids, numpy.asarray(cids, dtype=numpy.int64))
+        return Postings.remove_deleted(
+            self.cid_doc_ids[indices], self.is_deleted)
+
+    # returns cids of all replies to any of the parent_cids, except deleted
+    # ones
+    def get_reply_cids(self, parent_cids):
+        indices, _ = find_sorted(self.reply_to_parent_cids,
+                                 numpy.asarray(parent_cids, dtype=numpy.int64))
+        starts = self.reply_to_offsets[indices]
+        reply_indices = concatenate_ranges(
+            starts, self.reply_to_offsets[indices + 1] - starts)
+        if self.is_deleted is not None:
+            reply_indices = reply_indices[
+                ~self.is_deleted[self.reply_to_doc_ids[reply_indices]]]
+        return self.reply_to_cids[reply_indices]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import shutil
+import zlib
+
+import numpy
+
+from Common import *
+
+# the fields of the comments of a segment needed to print results, stored in
+# order of their doc ids in zlib compressed blocks of up to block_size
+# comments, so printing a page of results decompresses a few blocks instead
+# of parsing comments.csv
+# a record is (cid, article id, author id, text, timestamp, parent cid,
+# upvotes, downvotes) like a line of comments.csv, -1 for no parent
+# each block consists of
+# int64 array of the numbers of each record, shape (len(number_fields), n) |
+# UTF-8 encoded texts | UTF-8 encoded timestamps
+# stored_field_blocks.npy holds the first doc id and byte offset of each block
+# and the end of the last one
+block_size = 64
+number_fields = (0, 1, 2, 5, 6, 7)  # indices of the numbers in a record
+string_fields = (3, 4)
+
+
+# returns the record of the fields of a line of comments.csv
+def parse_record(csv_line):
+    return (int(csv_line[0]), int(csv_line[1]), int(csv_line[2]),
+            csv_line[3], csv_line[4],
+            int(csv_line[5]) if csv_line[5] != '' else -1,
+            int(csv_line[6]) if len(csv_line) >= 7 else 0,
+            int(csv_line[7]) if len(csv_line) >= 8 else 0)
+
+
+def encode_block(records):
+    numbers = numpy.array([[record[field] for record in records]
+                           for field in number_fields], dtype=numpy.int64)
+    strings = [[record[field].encode() for record in records]
+               for field in string_fields]
+    string_sizes = numpy.array([[len(string) for string in field_strings]
+                                for field_strings in strings],
+                               dtype=numpy.int64)
+    return zlib.compress(numbers.tobytes() + string_sizes.tobytes()
+                         + b''.join(b''.join(field_strings)
+                                    for field_strings in strings))
+
+
+def decode_block(block, record_count):
+    data = zlib.decompress(block)
+    numbers = numpy.frombuffer(
+        data, dtype=numpy.int64,
+        count=(len(number_fields) + len(string_fields)) * record_count
+    ).reshape(-1, record_count)
+    string_sizes = numbers[len(number_fields):]
+    string_ends = numpy.cumsum(string_sizes.ravel()) + numbers.nbytes
+    string_starts = string_ends - string_sizes.ravel()
+    strings = [data[start:end].decode() for start, end
+               in zip(string_starts.tolist(), string_ends.tolist())]
+    fields = [None] * 8
+    for i, field in enumerate(number_fields):
+        fields[field] = numbers[i].tolist()
+    for i, field in enumerate(string_fields):
+        fields[field] = strings[i * record_count:(i + 1) * record_count]
+    return list(zip(*fields))
+
+
+# writes the blocks of consecutive records to file_path, several files
+# written by StoredFieldsWriter can be concatenated with
+# concatenate_stored_fields
+class StoredFieldsWriter():
+    def __init__(self, file_path):
+        self.file = open(file_path, mode='wb')
+        self.records = []
+        # record count and size in bytes of each written block
+        self.block_record_counts = []
+        self.block_sizes = []
+
+    def add(self, record):
+        self.records.append(record)
+        if len(self.records) == block_size:
+            self.write_block()
+
+    def write_block(self):
+        if len(self.records) == 0:
+            return
+        block = encode_block(self.records)
+        self.file.write(block)
+        self.block_record_counts.append(len(self.records))
+        self.block_sizes.append(len(block))
+        self.records = []
+
+    # returns the record counts and sizes of the written blocks
+    def close(self):
+        self.write_block()
+        self.file.close()
+        return self.block_record_counts, self.block_sizes
+
+
+def save_stored_field_blocks(directory, block_record_counts, block_sizes):
+    blocks = numpy.zeros((2, len(block_sizes) + 1), dtype=numpy.int64)
+    numpy.cumsum(block_record_counts, out=blocks[0, 1:])
+    numpy.cumsum(block_sizes, out=blocks[1, 1:])
+    numpy.save(f'{directory}/stored_field_blocks.npy', blocks)
+
+
+# writes the stored fields of a segment from the files and block lists of
+# StoredFieldsWriters in order of their records
+# parts: list of (file path, block record counts, block sizes)
+def concatenate_stored_fields(directory, parts):
+    with open(f'{directory}/stored_fields', mode='wb') as f:
+        for file_path, _, _ in parts:
+            with open(file_path, mode='rb') as part_file:
+                shutil.copyfileobj(part_file, f)
+    save_stored_field_blocks(
+        directory, [count for _, counts, _ in parts for count in counts],
+        [size for _, _, sizes in parts for size in sizes])
+
+
+class StoredFields():
+    def __init__(self, directory):
+        self.data = memory_map(f'{directory}/stored_fields')
+        self.block_doc_ids, self.block_offsets = numpy.load(
+            f'{directory}/stored_field_blocks.npy')
+
+    def decode_block(self, block_index):
+        return decode_block(
+            self.data[self.block_offsets[block_index]:
+                      self.block_offsets[block_index + 1]],
+            int(self.block_doc_ids[block_index + 1]
+                - self.block_doc_ids[block_index]))
+
+    # yields the records of the sorted array doc_ids, every block is
+    # decompressed only once
+    def iterate_records(self, doc_ids):
+        doc_ids = numpy.asarray(doc_ids, dtype=numpy.int64)
+        block_indices = numpy.searchsorted(
+            self.block_doc_ids, doc_ids, side='right') - 1
+        block_starts = numpy.flatnonzero(numpy.diff(
+            block_indices, prepend=-1))
+        for start, end in zip(block_starts.tolist(),
+                              block_starts[1:].tolist() + [len(doc_ids)]):
+            block_index = block_indices[start]
+            records = self.decode_block(block_index)
+            for doc_id in (doc_ids[start:end] -
+                           self.block_doc_ids[block_index]).tolist():
+                yield records[doc_id]
+
+    # returns the records of doc_ids in the same order
+    def get_records(self, doc_ids):
+        unique_doc_ids, indices = numpy.unique(
+            numpy.asarray(doc_ids, dtype=numpy.int64), return_inverse=True)
+        records = list(self.iterate_records(unique_doc_ids))
+        return [records[index] for index in indices.tolist()]
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        records = [(i, i % 3, i % 5, f'text {i} ä', '2017-01-01', i - 1,
+                    i % 7, 0) for i in range(150)]
+        parts = []
+        for part_number, part_records in enumerate(
+                (records[:100], records[100:])):
+            file_path = f'{directory}/part_{part_number}'
+            writer = StoredFieldsWriter(file_path)
+            for record in part_records:
+                writer.add(record)
+            parts.append((file_path,) + writer.close())
+        concatenate_stored_fields(directory, parts)
+        for file_path, _, _ in parts:
+            os.remove(file_path)
+        stored_fields = StoredFields(directory)
+        assert(stored_fields.block_doc_ids.tolist() == [0, 64, 100, 150])
+        assert(stored_fields.get_records([149, 3, 64, 3])
+               == [records[149], records[3], records[64], records[3]])
+        print('ok')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import numpy
+
+
+# variable byte encoding: 7 bits of payload per byte, least significant group
+# first, the high bit is set on every byte except the last byte of a number:
+# 300 -> 10101100 00000010
+def encode(numbers):
+    numbers = numpy.asarray(numbers, dtype=numpy.uint64).ravel()
+    if len(numbers) == 0:
+        return b''
+    byte_counts = numpy.ones(len(numbers), dtype=numpy.int64)
+    for shift in range(7, 64, 7):
+        byte_counts += numbers >= (numpy.uint64(1) << numpy.uint64(shift))
+    group_ends = numpy.cumsum(byte_counts)
+    group_starts = group_ends - byte_counts
+    # index of each output byte within the group of its number
+    byte_index = numpy.arange(group_ends[-1]) - numpy.repeat(
+        group_starts, byte_counts)
+    shifted = numpy.repeat(numbers, byte_counts) >> \
+        (7 * byte_index).astype(numpy.uint64)
+    encoded = (shifted & numpy.uint64(0x7f)).astype(numpy.uint8)
+    encoded[byte_index < numpy.repeat(byte_counts, byte_counts) - 1] |= 0x80
+    return encoded.tobytes()
+
+
+# returns numpy.int64 array of the first count numbers (all if count is None)
+def decode(binary_data, count=None):
+    data = numpy.frombuffer(binary_data, dtype=numpy.uint8)
+    group_ends = numpy.flatnonzero(data < 0x80)
+    if count is not None:
+        group_ends = group_ends[:count]
+    if len(group_ends) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    data = data[:group_ends[-1] + 1]
+    group_starts = numpy.empty_like(group_ends)
+    group_starts[0] = 0
+    group_starts[1:] = group_ends[:-1] + 1
+    byte_index = numpy.arange(len(data)) - numpy.repeat(
+        group_starts, group_ends - group_starts + 1)
+    values = (data & 0x7f).astype(numpy.uint64) << \
+        (7 * byte_index).astype(numpy.uint64)
+    return numpy.add.reduceat(values, group_starts).astype(numpy.int64)
+
+
+# returns the number of bytes used by the first count numbers
+def encoded_size(binary_data, count):
+    if count == 0:
+        return 0
+    data = numpy.frombuffer(binary_data, dtype=numpy.uint8)
+    return int(numpy.flatnonzero(data < 0x80)[count - 1]) + 1
+
+
+def delta_encode(sorted_numbers):
+    sorted_numbers = numpy.asarray(sorted_numbers, dtype=numpy.int64)
+    return encode(numpy.diff(sorted_numbers, prepend=0))
+
+
+def delta_decode(binary_data, count=None):
+    return numpy.cumsum(decode(binary_data, count))
+
+
+if __name__ == '__main__':
+    numbers = [0, 1, 127, 128, 300, 16384, 2**40, 2**63 - 1]
+    encoded_numbers = encode(numbers)
+    decoded_numbers = decode(encoded_numbers)
+
+    print(f'numbers: {numbers}')
+    print(f'encoded: {encoded_numbers}')
+    print(f'decoded: {decoded_numbers.tolist()}')
+    assert(decoded_numbers.tolist() == numbers)
+    assert(delta_decode(delta_encode([3, 10, 11, 500])).tolist()
+           == [3, 10, 11, 500])
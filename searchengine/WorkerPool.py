@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+import threading
+import traceback
+
+# pre-forked worker processes evaluating requests in parallel, each with its
+# own copy of a loaded SearchEngine
+# the pool must be created before any thread or event loop is started, the
+# workers are forked from the process holding the loaded index, so they share
+# the pages of its memory mapped files (binary_index, stored_fields and the
+# npy arrays) instead of loading them again, all index files are read through
+# read only memory maps without file positions, so no reads interfere
+# requests are put into one queue all idle workers take the next request
+# from, so a worker busy with an expensive query never delays cheap ones
+# while other workers are idle
+
+
+class WorkerPool():
+    # functions: the functions requests can call by name, each one is called
+    # with the search engine of the worker as first argument
+    # worker_count: number of worker processes, one per core by default
+    def __init__(self, search_engine, functions, worker_count=None):
+        self.functions = functions
+        context = multiprocessing.get_context('fork')
+        self.requests = context.Queue()  # (request id, function name, args)
+        self.responses = context.Queue()  # (request id, outcome, value)
+        self.request_ids = itertools.count()
+        self.pending = {}  # request id -> future of the response
+        self.workers = [
+            context.Process(target=self.work, args=(search_engine,),
+                            daemon=True)
+            for _ in range(worker_count or os.cpu_count())]
+        for worker in self.workers:
+            worker.start()
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def __len__(self):
+        return len(self.workers)
+
+    # runs in the worker processes
+    # outcomes: 'result', 'error' for RuntimeErrors like unparsable queries
+    # and 'failure' for any other exception
+    def work(self, search_engine):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            request_id, function_name, args = request
+            try:
+                response = (request_id, 'result', self.functions[
+                    function_name](search_engine, *args))
+            except RuntimeError as error:
+                response = (request_id, 'error', str(error))
+            except Exception as error:
+                traceback.print_exc()
+                response = (request_id, 'failure', repr(error))
+            self.responses.put(response)
+
+    # passes the responses of the workers to the futures waiting for them
+    def receive(self):
+        while True:
+            response = self.responses.get()
+            if response is None:
+                break
+            future = self.pending.pop(response[0], None)
+            if future is not None:
+                future.get_loop().call_soon_threadsafe(
+                    set_response, future, response[1], response[2])
+
+    # returns the result of calling function_name with args in the next idle
+    # worker, raises RuntimeError for errors of the function
+    # a request cancelled by a timeout still occupies its worker until it is
+    # finished, its response is dropped
+    async def run(self, function_name, *args):
+        future = asyncio.get_running_loop().create_future()
+        request_id = next(self.request_ids)
+        self.pending[request_id] = future
+        self.requests.put((request_id, function_name, args))
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    def close(self):
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.responses.put(None)
+        self.receiver.join()
+
+
+def set_response(future, outcome, value):
+    if future.done():  # cancelled meanwhile
+        return
+    if outcome == 'result':
+        future.set_result(value)
+    elif outcome == 'error':
+        future.set_exception(RuntimeError(value))
+    else:
+        future.set_exception(Exception(f'worker failed: {value}'))